@@ -1,11 +1,16 @@
+import time
+
 import numpy as np
+import torch
 from sklearn.decomposition import PCA
+from torch.distributions import Normal, kl_divergence as kl
 
-from scvi.dataset import CortexDataset
+from scvi.dataset import CortexDataset, SyntheticDataset
 from scvi.inference import UnsupervisedTrainer, TrainerFish
 from scvi.inference.annotation import compute_accuracy_nn
 from scvi.inference.posterior import proximity_imputation
 from scvi.models import VAE, VAEF, LDVAE
+from scvi.models.utils import reparameterize, kl_normal
 
 
 def cortex_benchmark(n_epochs=250, use_cuda=True, save_path='data/', show_plot=True):
@@ -68,6 +73,7 @@ def all_benchmarks(n_epochs=250, use_cuda=True, save_path='data/', show_plot=Tru
 
     harmonization_benchmarks(n_epochs=n_epochs, use_cuda=use_cuda, save_path=save_path)
     annotation_benchmarks(n_epochs=n_epochs, use_cuda=use_cuda, save_path=save_path)
+    mixed_precision_benchmarks(n_epochs=n_epochs, use_cuda=use_cuda, save_path=save_path)
 
 
 def benchmark_fish_scrna(gene_dataset_seq, gene_dataset_fish):
@@ -93,3 +99,67 @@ def benchmark_fish_scrna(gene_dataset_seq, gene_dataset_fish):
     _ = proximity_imputation(pca_latent_seq, pca_values_seq[:, 0], pca_latent_fish, k=5)
     _, _, = compute_accuracy_nn(pca_latent_seq, pca_labels_seq.ravel(), pca_latent_fish,
                                 pca_labels_fish.ravel())
+
+
+def elbo_overhead_benchmark(n_cells=128, n_latent=10, n_steps=1000):
+    r"""Micro-benchmark of the Gaussian terms of the ELBO (reparameterized sampling of z, KL of z and l)
+    computed with ``torch.distributions`` objects versus the closed forms of ``scvi.models.utils``,
+    forward and backward, on small CPU batches where this overhead matters.
+
+    :return: dict with the mean time per step in seconds of each path
+    """
+    qz_m, qz_v = torch.randn(n_cells, n_latent, requires_grad=True), torch.rand(n_cells, n_latent) + 0.1
+    ql_m, ql_v = torch.randn(n_cells, 1, requires_grad=True), torch.rand(n_cells, 1) + 0.1
+    local_l_mean, local_l_var = torch.randn(n_cells, 1), torch.rand(n_cells, 1) + 0.1
+
+    def distributions_step():
+        z = Normal(qz_m, qz_v.sqrt()).rsample()
+        kl_divergence_z = kl(Normal(qz_m, torch.sqrt(qz_v)),
+                             Normal(torch.zeros_like(qz_m), torch.ones_like(qz_v))).sum(dim=1)
+        kl_divergence_l = kl(Normal(ql_m, torch.sqrt(ql_v)), Normal(local_l_mean, torch.sqrt(local_l_var))).sum(dim=1)
+        (z.sum() + kl_divergence_z.sum() + kl_divergence_l.sum()).backward()
+
+    def closed_form_step():
+        z = reparameterize(qz_m, qz_v)
+        kl_divergence_z = kl_normal(qz_m, qz_v).sum(dim=1)
+        kl_divergence_l = kl_normal(ql_m, ql_v, local_l_mean, local_l_var).sum(dim=1)
+        (z.sum() + kl_divergence_z.sum() + kl_divergence_l.sum()).backward()
+
+    timings = {}
+    for name, step in [('distributions', distributions_step), ('closed_form', closed_form_step)]:
+        step()  # warm up
+        start = time.perf_counter()
+        for _ in range(n_steps):
+            step()
+        timings[name] = (time.perf_counter() - start) / n_steps
+    return timings
+
+
+def mixed_precision_benchmark(dataset, n_epochs=250, use_cuda=False, frequency=None):
+    r"""Trains a ``VAE`` on ``dataset`` (e.g. ``CortexDataset`` or ``SyntheticDataset``) in float32 and with
+    a bfloat16 autocast (``mixed_precision=True``), from the same initialization and train/test split,
+    to compare their convergence.
+
+    :return: dict with, for each mode, the training time and the history of the test ll
+    """
+    frequency = frequency if frequency is not None else max(n_epochs // 10, 1)
+    results = {}
+    for name, mixed_precision in [('float32', False), ('bfloat16', True)]:
+        np.random.seed(0)
+        torch.manual_seed(0)
+        vae = VAE(dataset.nb_genes, n_batch=dataset.n_batches)
+        trainer = UnsupervisedTrainer(vae, dataset, use_cuda=use_cuda, frequency=frequency,
+                                      metrics_to_monitor=['ll'], mixed_precision=mixed_precision)
+        trainer.train(n_epochs=n_epochs)
+        results[name] = {'training_time': trainer.training_time, 'll_test_set': trainer.history['ll_test_set']}
+    return results
+
+
+def mixed_precision_benchmarks(n_epochs=250, use_cuda=True, save_path='data/'):
+    r"""``mixed_precision_benchmark`` on ``SyntheticDataset`` and ``CortexDataset``, downloaded to ``save_path``
+
+    :return: dict with the results of ``mixed_precision_benchmark`` for each dataset
+    """
+    return {'synthetic': mixed_precision_benchmark(SyntheticDataset(), n_epochs=n_epochs, use_cuda=use_cuda),
+            'cortex': mixed_precision_benchmark(CortexDataset(save_path=save_path), n_epochs=n_epochs,
+                                                use_cuda=use_cuda)}
@@ -4,7 +4,10 @@
 For the moment, is initialized with a torch Tensor of size (n_cells, nb_genes)"""
 import copy
 import os
+import pickle
 import urllib.request
+import weakref
+from multiprocessing.reduction import ForkingPickler
 
 import numpy as np
 import scipy.sparse as sp_sparse
@@ -12,6 +15,11 @@ import torch
 from sklearn.preprocessing import StandardScaler
 from torch.utils.data import Dataset
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
 
 class GeneExpressionDataset(Dataset):
     """Gene Expression dataset. It deals with:
@@ -55,6 +63,72 @@ class GeneExpressionDataset(Dataset):
         self._X = X
         self.library_size_batch()
 
+    def share_memory(self):
+        """
+        Moves the expression matrix (dense array or CSR component arrays) and the per-cell attributes into
+        named shared memory blocks. While shared, sending the dataset to other processes through ``multiprocessing``
+        (e.g. to spawned ``DataLoader`` workers) or through ``shared_reference`` only records the names of the
+        blocks, which are attached without copy when unpickling, so that N worker processes cost one copy of the
+        data instead of N. Other pickles and copies, e.g. ``pickle.dumps`` or ``copy.deepcopy``, copy the data.
+        Blocks are released by ``unshare_memory`` or when the dataset that created them is garbage collected:
+        a dataset sent to workers is only valid in the meantime, and on the same host.
+        On python < 3.8, which lacks ``multiprocessing.shared_memory``, the dataset is left unchanged and is
+        copied when pickled.
+        :return: the dataset itself
+        """
+        if getattr(self, '_shared_handles', None) or shared_memory is None:
+            return self
+        blocks = []
+        self._shared_handles = {}
+        for attr_name in _shared_attributes:
+            value = getattr(self, attr_name, None)
+            if attr_name == '_X' and sp_sparse.isspmatrix_csr(value):
+                arrays = [_to_shared_array(a, blocks) for a in (value.data, value.indices, value.indptr)]
+                value = sp_sparse.csr_matrix(tuple(a for a, _ in arrays), shape=value.shape, copy=False)
+                handle = ('csr', value.shape, [h for _, h in arrays])
+            elif isinstance(value, np.ndarray):
+                value, handle = _to_shared_array(value, blocks)
+                handle = ('dense', value.shape, handle)
+            else:
+                continue
+            self.__dict__[attr_name] = value
+            self._shared_handles[attr_name] = (value, handle)
+        self._shared_finalizer = weakref.finalize(self, _release_shared_blocks, blocks, True)
+        return self
+
+    def unshare_memory(self):
+        """
+        Copies the shared attributes back into private memory and releases the shared memory blocks.
+        :return: the dataset itself
+        """
+        for attr_name, (value, _) in getattr(self, '_shared_handles', {}).items():
+            if self.__dict__.get(attr_name) is value:
+                self.__dict__[attr_name] = value.copy()
+        finalizer = getattr(self, '_shared_finalizer', None)
+        self._shared_handles, self._shared_finalizer = {}, None
+        if finalizer is not None:
+            finalizer()
+        return self
+
+    def shared_reference(self):
+        """
+        A placeholder for the dataset which, whatever the pickler (e.g. the one of hyperopt's ``MongoTrials``),
+        is pickled as in ``multiprocessing``: while the dataset is shared, as the names of its shared memory blocks.
+        It is unpickled as the dataset itself.
+        """
+        return _SharedDatasetReference(self)
+
+    def __getstate__(self):
+        # pickles and copies get the data, only the ones of multiprocessing attach to the blocks (_reduce_for_workers)
+        state = self.__dict__.copy()
+        state.pop('_shared_handles', None)
+        state.pop('_shared_finalizer', None)
+        return state
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        ForkingPickler.register(cls, _reduce_for_workers)
+
     def __len__(self):
         return self.X.shape[0]
 
@@ -70,6 +144,12 @@ class GeneExpressionDataset(Dataset):
         X = self.X[indexes]
         return self.collate_fn_end(X, indexes)
 
+    def collate_fn_sparse(self, batch):
+        '''Same as collate_fn, with X as a torch.sparse COO tensor, for models to scale with the nonzero counts.'''
+        indexes = np.array(batch)
+        X = sp_sparse.coo_matrix(self.X[indexes])
+        return self.collate_fn_end(X, indexes)
+
     def collate_fn_corrupted(self, batch):
         '''On the fly corruption is slow, but might be optimized in pytorch. Numpy code left here.'''
         indexes = np.array(batch)
@@ -92,7 +172,10 @@ class GeneExpressionDataset(Dataset):
         self.corrupted_X[i, j] = corrupted
 
     def collate_fn_end(self, X, indexes):
-        if self.dense:
+        if sp_sparse.isspmatrix_coo(X):
+            X = torch.sparse_coo_tensor(torch.from_numpy(np.vstack((X.row, X.col)).astype(np.int64)),
+                                        torch.from_numpy(X.data.astype(np.float32)), X.shape).coalesce()
+        elif self.dense:
             X = torch.from_numpy(X)
         else:
             X = torch.FloatTensor(X.toarray())
@@ -412,6 +495,82 @@ class GeneExpressionDataset(Dataset):
         return gene_dataset.X[:, subset_genes], subset_genes
 
 
+# Attributes moved to shared memory by GeneExpressionDataset.share_memory
+_shared_attributes = ['_X', 'labels', 'batch_indices', 'local_means', 'local_vars', 'x_coord', 'y_coord']
+
+
+class _SharedDatasetReference:
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __reduce__(self):
+        return _reduce_for_workers(self.dataset)
+
+
+def _reduce_for_workers(dataset):
+    """Reduction of the datasets sent to other processes: a shared dataset is reduced to the names of its blocks"""
+    shared_handles = getattr(dataset, '_shared_handles', None)
+    if not shared_handles:
+        return dataset.__reduce_ex__(pickle.DEFAULT_PROTOCOL)
+    state = dataset.__getstate__()
+    handles = {}
+    for attr_name, (value, handle) in shared_handles.items():
+        if state.get(attr_name) is value:  # otherwise replaced since it was shared, e.g. by update_cells
+            handles[attr_name] = handle
+            del state[attr_name]
+    return _attach_shared_dataset, (type(dataset), state, handles)
+
+
+def _attach_shared_dataset(cls, state, handles):
+    dataset = cls.__new__(cls)
+    dataset.__dict__.update(state)
+    blocks = []
+    dataset._shared_handles = {}
+    for attr_name, handle in handles.items():
+        kind, shape, array_handles = handle
+        if kind == 'csr':
+            arrays = [_attach_shared_array(h, blocks) for h in array_handles]
+            value = sp_sparse.csr_matrix(tuple(arrays), shape=shape, copy=False)
+        else:
+            value = _attach_shared_array(array_handles, blocks)
+        dataset.__dict__[attr_name] = value
+        dataset._shared_handles[attr_name] = (value, handle)
+    # attached blocks are only closed, the process which created them is in charge of unlinking them
+    dataset._shared_finalizer = weakref.finalize(dataset, _release_shared_blocks, blocks, False) if blocks else None
+    return dataset
+
+
+ForkingPickler.register(GeneExpressionDataset, _reduce_for_workers)
+
+
+def _to_shared_array(array, blocks):
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    blocks.append(block)
+    shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+    shared_array[...] = array
+    return shared_array, (block.name, array.shape, array.dtype.str)
+
+
+def _attach_shared_array(handle, blocks):
+    name, shape, dtype = handle
+    try:
+        block = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # python < 3.13, child processes register the block to the resource tracker of their parent
+        block = shared_memory.SharedMemory(name=name)
+    blocks.append(block)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+
+def _release_shared_blocks(blocks, unlink):
+    for block in blocks:
+        if unlink:
+            block.unlink()
+        try:
+            block.close()
+        except BufferError:  # arrays still referencing the block, its memory is freed with them
+            pass
+
+
 def arrange_categories(original_categories, mapping_from=None, mapping_to=None):
     unique_categories = np.unique(original_categories)
     n_categories = len(unique_categories)
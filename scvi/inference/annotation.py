@@ -23,6 +23,7 @@ class AnnotationPosterior(Posterior):
     def accuracy(self, verbose=False):
         model, cls = (self.sampling_model, self.model) if hasattr(self, 'sampling_model') else (self.model, None)
         acc = compute_accuracy(model, self, classifier=cls, model_zl=self.model_zl)
+        self.std_error = float(np.sqrt(acc * (1 - acc) / max(len(self.indices), 1)))
         if verbose:
             print("Acc: %.4f" % (acc))
         return acc
@@ -53,6 +54,39 @@ class AnnotationPosterior(Posterior):
         model, cls = (self.sampling_model, self.model) if hasattr(self, 'sampling_model') else (self.model, None)
         return compute_predictions(model, self, classifier=cls, soft=soft, model_zl=self.model_zl)
 
+    @torch.no_grad()
+    def marginalization_gap(self, top_k, verbose=False):
+        '''
+        Approximation error of enumerating only the ``top_k`` most probable labels of each unlabelled cell
+        (see ``SemiSupervisedTrainer``) for a ``SCANVI`` or ``VAEC`` model, on the cells of this posterior.
+        The loss of every cell is computed for each label, with the same samples of the latent variables, then
+        averaged with the probabilities of ``classify`` over all labels (exact) or over the ``top_k`` most
+        probable ones, renormalized (approximation).
+        :return: the mean absolute difference of the loss per cell, relative to the mean exact loss
+        '''
+        gap, exact = 0, 0
+        for tensors in self:
+            sample_batch, local_l_mean, local_l_var, batch_index, _ = tensors
+            probs = self.model.classify(sample_batch)
+            seed = int(torch.randint(2 ** 31, (1,)).item())
+            losses = []
+            with torch.random.fork_rng(devices=None if sample_batch.is_cuda else []):
+                for label in range(self.model.n_labels):
+                    torch.manual_seed(seed)  # common random numbers for all labels
+                    y = torch.full_like(batch_index, label, dtype=torch.long)
+                    reconst_loss, kl_divergence = self.model(sample_batch, local_l_mean, local_l_var, batch_index, y)
+                    losses += [reconst_loss + kl_divergence]
+            losses = torch.stack(losses, dim=-1)
+            top_probs, top_labels = probs.topk(top_k, dim=-1)
+            top_k_probs = torch.zeros_like(probs).scatter_(1, top_labels, top_probs / top_probs.sum(-1, keepdim=True))
+            loss_exact = (losses * probs).sum(dim=-1)
+            gap += torch.sum(torch.abs((losses * top_k_probs).sum(dim=-1) - loss_exact)).item()
+            exact += torch.sum(torch.abs(loss_exact)).item()
+        relative_gap = gap / exact
+        if verbose:
+            print("Top %d marginalization gap : %.4f" % (top_k, relative_gap))
+        return relative_gap
+
     @torch.no_grad()
     def unsupervised_classification_accuracy(self, classifier=None, verbose=False):
         all_y, all_y_pred = self.compute_predictions()
@@ -128,11 +162,11 @@ class ClassifierTrainer(Trainer):
                 if self.sampling_model.log_variational:
                     x = torch.log(1 + x)
                 if self.sampling_zl:
-                    x_z = self.sampling_model.z_encoder(x)[0]
-                    x_l = self.sampling_model.l_encoder(x)[0]
+                    x_z = self.sampling_model.z_encoder.encode_mean(x)
+                    x_l = self.sampling_model.l_encoder.encode_mean(x)
                     x = torch.cat((x_z, x_l), dim=-1)
                 else:
-                    x = self.sampling_model.z_encoder(x)[0]
+                    x = self.sampling_model.z_encoder.encode_mean(x)
         return F.cross_entropy(self.model(x), labels_train.view(-1))
 
     @torch.no_grad()
@@ -152,13 +186,16 @@ class SemiSupervisedTrainer(UnsupervisedTrainer):
     """
 
     def __init__(self, model, gene_dataset, n_labelled_samples_per_class=50, n_epochs_classifier=1,
-                 lr_classification=5 * 1e-3, classification_ratio=50, seed=0, **kwargs):
+                 lr_classification=5 * 1e-3, classification_ratio=50, seed=0, top_k=None, **kwargs):
         """
         :param n_labelled_samples_per_class: number of labelled samples per class
+        :param top_k: if not ``None``, the loss of unlabelled cells only enumerates their ``top_k`` most probable
+         labels, see ``AnnotationPosterior.marginalization_gap`` for the resulting approximation error
         """
         super().__init__(model, gene_dataset, **kwargs)
         self.model = model
         self.gene_dataset = gene_dataset
+        self.top_k = top_k
 
         self.n_epochs_classifier = n_epochs_classifier
         self.lr_classification = lr_classification
@@ -184,7 +221,7 @@ class SemiSupervisedTrainer(UnsupervisedTrainer):
 
         self.classifier_trainer = ClassifierTrainer(
             model.classifier, gene_dataset, metrics_to_monitor=[], verbose=True, frequency=0,
-            sampling_model=self.model
+            sampling_model=self.model, distributed=self.distributed
         )  # verbose = True removes the "loading bar", whereas frequency = 0 ensures we don't compute metrics
 
         self.full_dataset = self.create_posterior(shuffle=True)
@@ -203,8 +240,12 @@ class SemiSupervisedTrainer(UnsupervisedTrainer):
             self.classifier_trainer.train_set = value
         super().__setattr__(key, value)
 
+    def unsupervised_loss(self, tensors):
+        kwargs = {'top_k': self.top_k} if self.top_k is not None else {}
+        return super().loss(tensors, **kwargs)
+
     def loss(self, tensors_all, tensors_labelled):
-        loss = super().loss(tensors_all)
+        loss = self.unsupervised_loss(tensors_all)
         sample_batch, _, _, _, y = tensors_labelled
         classification_loss = F.cross_entropy(self.model.classify(sample_batch), y.view(-1))
         loss += classification_loss * self.classification_ratio
@@ -212,7 +253,8 @@ class SemiSupervisedTrainer(UnsupervisedTrainer):
 
     def on_epoch_end(self):
         self.model.eval()
-        self.classifier_trainer.train(self.n_epochs_classifier, lr=self.lr_classification)
+        with self.profiler.phase('classifier'):
+            self.classifier_trainer.train(self.n_epochs_classifier, lr=self.lr_classification)
         self.model.train()
         return super().on_epoch_end()
 
@@ -232,7 +274,7 @@ class AlternateSemiSupervisedTrainer(SemiSupervisedTrainer):
         super().__init__(*args, **kwargs)
 
     def loss(self, all_tensor):
-        return UnsupervisedTrainer.loss(self, all_tensor)
+        return self.unsupervised_loss(all_tensor)
 
     @property
     def posteriors_loop(self):
@@ -256,11 +298,11 @@ def compute_predictions(model, data_loader, classifier=None, soft=False, model_z
                 if model.log_variational:
                     sample_batch = torch.log(1 + sample_batch)
                 if model_zl:
-                    sample_z = model.z_encoder(sample_batch)[0]
-                    sample_l = model.l_encoder(sample_batch)[0]
+                    sample_z = model.z_encoder.encode_mean(sample_batch)
+                    sample_l = model.l_encoder.encode_mean(sample_batch)
                     sample_batch = torch.cat((sample_z, sample_l), dim=-1)
                 else:
-                    sample_batch, _, _ = model.z_encoder(sample_batch)
+                    sample_batch = model.z_encoder.encode_mean(sample_batch)
             y_pred = classifier(sample_batch)
         else:  # The model is the raw classifier
             y_pred = model(sample_batch)
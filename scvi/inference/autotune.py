@@ -320,7 +320,8 @@ def auto_tune_scvi_model(
     )
 
     # build a partial objective function restricted to the search space
-    if objective_hyperopt is None:
+    default_objective = objective_hyperopt is None
+    if default_objective:
         objective_hyperopt = partial(
             _objective_function,
             **{
@@ -336,23 +337,36 @@ def auto_tune_scvi_model(
 
     if parallel:
         logger.info("Starting parallel hyperoptimization")
-        trials = _auto_tune_parallel(
-            objective_hyperopt=objective_hyperopt,
-            exp_key=exp_key,
-            space=space,
-            max_evals=max_evals,
-            save_path=save_path,
-            n_cpu_workers=n_cpu_workers,
-            gpu_ids=gpu_ids,
-            n_workers_per_gpu=n_workers_per_gpu,
-            reserve_timeout=reserve_timeout,
-            fmin_timeout=fmin_timeout,
-            fmin_timer=fmin_timer,
-            mongo_port=mongo_port,
-            mongo_host=mongo_host,
-            db_name=db_name,
-            multiple_hosts=multiple_hosts,
-        )
+        # workers on this host attach to the dataset's shared memory rather than unpickling a full copy
+        share_dataset = not multiple_hosts and hasattr(gene_dataset, "share_memory")
+        parallel_objective = objective_hyperopt
+        if share_dataset:
+            gene_dataset.share_memory()
+            if default_objective:
+                parallel_objective = partial(
+                    objective_hyperopt, gene_dataset=gene_dataset.shared_reference()
+                )
+        try:
+            trials = _auto_tune_parallel(
+                objective_hyperopt=parallel_objective,
+                exp_key=exp_key,
+                space=space,
+                max_evals=max_evals,
+                save_path=save_path,
+                n_cpu_workers=n_cpu_workers,
+                gpu_ids=gpu_ids,
+                n_workers_per_gpu=n_workers_per_gpu,
+                reserve_timeout=reserve_timeout,
+                fmin_timeout=fmin_timeout,
+                fmin_timer=fmin_timer,
+                mongo_port=mongo_port,
+                mongo_host=mongo_host,
+                db_name=db_name,
+                multiple_hosts=multiple_hosts,
+            )
+        finally:
+            if share_dataset:
+                gene_dataset.unshare_memory()
 
     else:
         logger.info("Starting sequential hyperoptimization")
@@ -0,0 +1,103 @@
+"""Checkpoints of training runs, written to disk by a background thread"""
+
+import os
+import queue
+import tempfile
+import threading
+
+import torch
+
+
+def snapshot(obj):
+    r"""A copy of ``obj`` (nested dicts, lists and tuples) whose tensors are detached copies on CPU, so that
+    it is not modified by the training steps that follow"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    r"""``torch.save`` to a temporary file renamed to ``path``: ``path`` is either the previous or the new
+    checkpoint, never a partially written file"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class Checkpointer:
+    r"""Writes the checkpoints of a ``Trainer`` in ``save_path``: the full training state, every ``frequency``
+    epochs, to ``filename``, and the weights of the best model (according to the ``save_best_state_metric`` of
+    the early stopping) to ``best_filename``. The states are copied on the training thread, and written by a
+    background thread. The training can be resumed from ``filename`` with ``Trainer.resume``.
+
+    :param save_path: Directory of the checkpoints. If ``None``, no checkpoint is written
+    :param frequency: Number of epochs between two checkpoints of the training state
+    :param save_best: Whether to write the best model
+    :param filename: File name of the training state
+    :param best_filename: File name of the best model
+    """
+
+    def __init__(self, save_path: str = None, frequency: int = 1, save_best: bool = True,
+                 filename: str = 'checkpoint.pt', best_filename: str = 'best.pt'):
+        self.save_path = save_path
+        self.frequency = frequency
+        self.save_best = save_best
+        self.filename = filename
+        self.best_filename = best_filename
+        self._queue = queue.Queue()
+        self._thread = None
+        self._error = None
+        if save_path is not None:
+            os.makedirs(save_path, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.save_path is not None
+
+    def due(self, epoch):
+        return self.enabled and bool(self.frequency) and (epoch + 1) % self.frequency == 0
+
+    def save(self, state, filename, copy=True):
+        r"""Queues ``state`` to be written to ``filename`` in ``save_path``
+
+        :param copy: Whether to ``snapshot`` ``state``, unless it is already a copy
+        """
+        self._raise_error()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._write_loop, daemon=True)
+            self._thread.start()
+        self._queue.put((snapshot(state) if copy else state, os.path.join(self.save_path, filename)))
+
+    def wait(self):
+        r"""Blocks until all the queued checkpoints are written"""
+        self._queue.join()
+        self._raise_error()
+
+    def _write_loop(self):
+        while True:
+            state, path = self._queue.get()
+            try:
+                if self._error is None:
+                    atomic_save(state, path)
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("a checkpoint could not be written") from error
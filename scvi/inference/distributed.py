@@ -0,0 +1,120 @@
+"""Data-parallel training across processes and nodes with ``torch.distributed``"""
+
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def shard_indices(indices, rank=None, world_size=None):
+    r"""The shard of ``indices`` sampled by ``rank``: shards are disjoint, and of equal length so that all the ranks
+    run the same number of steps per epoch, the first indices being repeated to pad ``indices`` if needed.
+
+    :param indices: Indices of the cells to share across ranks
+    :param rank: Default: the rank of the process
+    :param world_size: Default: the number of processes
+    :return: The indices of the shard, as a numpy array
+    """
+    rank = get_rank() if rank is None else rank
+    world_size = get_world_size() if world_size is None else world_size
+    indices = np.asarray(indices).ravel()
+    n_padded = -(-len(indices) // world_size) * world_size
+    indices = np.resize(indices, n_padded) if len(indices) else indices
+    return indices[rank::world_size]
+
+
+def broadcast_parameters(model, src=0):
+    r"""Copies the parameters and the buffers of ``model`` on rank ``src`` to the other ranks"""
+    with torch.no_grad():
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            dist.broadcast(tensor.data, src=src)
+
+
+def broadcast_buffers(model, src=0):
+    r"""Copies the buffers of ``model`` on rank ``src``, such as the ``BatchNorm`` running statistics,
+    to the other ranks"""
+    with torch.no_grad():
+        for tensor in model.buffers():
+            dist.broadcast(tensor.data, src=src)
+
+
+def all_reduce_gradients(params):
+    r"""Averages the gradients of ``params`` across ranks, in a single all-reduce of their concatenation.
+    A missing gradient counts as zero.
+
+    :param params: Parameters of the optimizer
+    """
+    params = [p for p in params if p.requires_grad]
+    if not params:
+        return
+    grads = [p.grad if p.grad is not None else torch.zeros_like(p) for p in params]
+    flat = torch.cat([grad.reshape(-1) for grad in grads])
+    dist.all_reduce(flat)
+    flat /= get_world_size()
+    offset = 0
+    for p in params:
+        numel = p.numel()
+        p.grad = flat[offset:offset + numel].view_as(p).clone()
+        offset += numel
+
+
+def all_reduce_mean(value, weight=1.):
+    r"""Mean of the scalar ``value`` of each rank, weighted by ``weight``, such as the number of cells
+    it was computed on"""
+    tensor = torch.tensor([float(value) * weight, float(weight)], dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return (tensor[0] / tensor[1]).item()
+
+
+def broadcast_flags(*flags, src=0):
+    r"""The booleans ``flags`` of rank ``src``, so that all the ranks take the same decisions"""
+    tensor = torch.tensor([bool(flag) for flag in flags], dtype=torch.uint8)
+    dist.broadcast(tensor, src=src)
+    return tuple(bool(flag) for flag in tensor.tolist())
+
+
+def _worker(rank, world_size, fn, args, master_addr, master_port):
+    os.environ['MASTER_ADDR'] = master_addr
+    os.environ['MASTER_PORT'] = str(master_port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        fn(*args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(fn, world_size, *args, master_addr='127.0.0.1', master_port=29500):
+    r"""Runs ``fn(*args)`` in ``world_size`` processes on this node, in a ``gloo`` process group, in which
+    trainers created with ``distributed=True`` train together. Across nodes, initialize the process group
+    of each process instead, for instance with ``torchrun``, and call ``fn`` directly.
+
+    Examples:
+        >>> def train(gene_dataset):
+        ...     torch.set_num_threads(4)
+        ...     vae = VAE(gene_dataset.nb_genes, n_batch=gene_dataset.n_batches)
+        ...     trainer = UnsupervisedTrainer(vae, gene_dataset, distributed=True, frequency=5)
+        ...     trainer.train(n_epochs=100)
+        ...     if get_rank() == 0:
+        ...         torch.save(vae.state_dict(), 'vae.pkl')
+        >>> launch(train, 16, CortexDataset())
+
+    :param fn: A picklable function, such as a function of a module
+    :param world_size: Number of processes
+    :param master_addr: Address of the rank 0 process
+    :param master_port: A free port of ``master_addr``
+    """
+    mp.spawn(_worker, args=(world_size, fn, args, master_addr, master_port), nprocs=world_size, join=True)
@@ -12,7 +12,7 @@ class FishPosterior(Posterior):
 
     @torch.no_grad()
     def ll(self, verbose=False):
-        ll = compute_log_likelihood(self.model, self, mode="smFISH")
+        ll, self.std_error = compute_log_likelihood(self.model, self, return_std_error=True, mode="smFISH")
         if verbose:
             print("LL Fish: %.4f" % ll)
         return ll
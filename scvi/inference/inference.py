@@ -40,9 +40,10 @@ class UnsupervisedTrainer(Trainer):
     def posteriors_loop(self):
         return ['train_set']
 
-    def loss(self, tensors):
+    def loss(self, tensors, **model_kwargs):
         sample_batch, local_l_mean, local_l_var, batch_index, _ = tensors
-        reconst_loss, kl_divergence = self.model(sample_batch, local_l_mean, local_l_var, batch_index)
+        reconst_loss, kl_divergence = self.model(sample_batch, local_l_mean, local_l_var, batch_index, **model_kwargs)
+        self.record_running_loss(reconst_loss, kl_divergence)
         loss = torch.mean(reconst_loss + self.kl_weight * kl_divergence)
         return loss
 
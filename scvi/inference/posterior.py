@@ -1,5 +1,6 @@
 from abc import abstractmethod
 import copy
+import multiprocessing
 
 import numpy as np
 import pandas as pd
@@ -19,7 +20,9 @@ from sklearn.utils.linear_assignment_ import linear_assignment
 from torch.utils.data import DataLoader
 from torch.utils.data.sampler import SequentialSampler, SubsetRandomSampler, RandomSampler
 
+from scvi.inference.distributed import shard_indices
 from scvi.models.log_likelihood import compute_log_likelihood, compute_marginal_log_likelihood
+from scvi.models.quantization import quantize_model
 
 
 class SequentialSubsetSampler(SubsetRandomSampler):
@@ -73,6 +76,7 @@ class Posterior:
         self.gene_dataset = gene_dataset
         self.to_monitor = []
         self.use_cuda = use_cuda
+        self.std_error = None  # standard error of the last metric computed, if it reports one
 
         if indices is not None and shuffle:
             raise ValueError('indices is mutually exclusive with shuffle')
@@ -89,6 +93,13 @@ class Posterior:
         if hasattr(gene_dataset, 'collate_fn'):
             self.data_loader_kwargs.update({'collate_fn': gene_dataset.collate_fn})
         self.data_loader_kwargs.update({'sampler': sampler})
+        if self.data_loader_kwargs.get('num_workers', 0) > 0 and hasattr(gene_dataset, 'share_memory'):
+            # Unless forked, workers receive a pickled copy of the dataset: share it instead of copying it
+            context = self.data_loader_kwargs.get('multiprocessing_context', None)
+            start_method = context if isinstance(context, str) else (
+                context.get_start_method() if context is not None else multiprocessing.get_start_method())
+            if start_method != 'fork':
+                gene_dataset.share_memory()
         self.data_loader = DataLoader(gene_dataset, **self.data_loader_kwargs)
 
     @abstractmethod
@@ -126,20 +137,98 @@ class Posterior:
     def uncorrupted(self):
         return self.update({'collate_fn': self.gene_dataset.collate_fn})
 
+    def sparse(self):
+        return self.update({'collate_fn': self.gene_dataset.collate_fn_sparse})
+
+    def quantized(self):
+        posterior = self.update({})
+        posterior.model = quantize_model(self.model)
+        posterior.use_cuda = False
+        return posterior
+
+    def shard(self, rank=None, world_size=None):
+        r"""The disjoint part of the cells of this posterior sampled by ``rank``, see ``shard_indices``.
+        The order of the cells is kept if it is sequential"""
+        indices = shard_indices(self.indices, rank=rank, world_size=world_size)
+        sequential = isinstance(self.data_loader.sampler, (SequentialSampler, SequentialSubsetSampler))
+        return self.update({'sampler': SequentialSubsetSampler(indices) if sequential
+                            else SubsetRandomSampler(indices)})
+
+    def subsample(self, n_cells, stratify=('batch_indices', 'labels'), seed=0):
+        r"""A posterior over a fixed random subset of the cells of this posterior, to compute its metrics at a cost
+        independent of its size. The cells are sampled without replacement within the strata of ``stratify``, in
+        proportion to their sizes, and in a fixed order, so that the metrics of successive epochs are computed on
+        the same cells. Metrics such as ``ll`` and ``accuracy`` report their ``std_error``.
+
+        :param n_cells: Number of cells of the subset
+        :param stratify: Attributes of the dataset whose combinations of values are the strata
+        :param seed: Seed of the random subset
+        """
+        indices = np.asarray(self.indices).ravel()
+        if n_cells < len(indices):
+            strata = np.zeros(len(indices), dtype=np.int64)
+            for attribute in stratify:
+                _, values = np.unique(np.asarray(getattr(self.gene_dataset, attribute)).ravel()[indices],
+                                      return_inverse=True)
+                strata = strata * (values.max() + 1) + values
+            _, strata = np.unique(strata, return_inverse=True)
+            sizes = np.bincount(strata)
+            # proportional allocation, the remaining cells going to the largest remainders
+            quotas = sizes * n_cells / len(indices)
+            n_cells_strata = np.floor(quotas).astype(np.int64)
+            n_cells_strata[np.argsort(n_cells_strata - quotas)[:n_cells - n_cells_strata.sum()]] += 1
+            random_state = np.random.RandomState(seed)
+            indices = np.concatenate([random_state.choice(indices[strata == stratum], n, replace=False)
+                                      for stratum, n in enumerate(n_cells_strata)])
+        return self.update({'sampler': SequentialSubsetSampler(np.sort(indices))})
+
     def ll(self, verbose=False):
-        ll = compute_log_likelihood(self.model, self)
+        ll, self.std_error = compute_log_likelihood(self.model, self, return_std_error=True)
         if verbose:
             print("LL : %.4f" % ll)
         return ll
 
     ll.mode = 'min'
 
-    def marginal_ll(self, verbose=False, n_mc_samples=1000):
-        ll = compute_marginal_log_likelihood(self.model, self, n_mc_samples)
+    def marginal_ll(self, verbose=False, n_mc_samples=1000, tol=None):
+        ll = compute_marginal_log_likelihood(self.model, self, n_mc_samples, tol=tol)
         if verbose:
             print("True LL : %.4f" % ll)
         return ll
 
+    @torch.no_grad()
+    def quantization_report(self, verbose=False, n_neighbors=15, seed=0):
+        """
+        Agreement of the int8 quantized model (see ``quantized``) with the float32 model, both in eval mode
+        :param n_neighbors: number of nearest neighbors in the latent space
+        :param seed: seed of the samples of both ll, for a common random numbers comparison
+        :return: dict with the relative error of the latent means ``||z_q - z|| / ||z||``, the mean fraction
+            of the ``n_neighbors`` nearest neighbors of the cells in the latent space which are preserved,
+            the ll of both models and their difference
+        """
+        training = self.model.training
+        self.model.eval()
+        posterior, quantized = self.sequential(), self.quantized().sequential()
+        latent, latent_quantized = posterior.get_latent()[0], quantized.get_latent()[0]
+        lls = []
+        for p in [posterior, quantized]:
+            with torch.random.fork_rng(devices=None if p.use_cuda else []):
+                torch.manual_seed(seed)
+                lls += [p.ll()]
+        self.model.train(training)
+        n_neighbors = min(n_neighbors, len(latent) - 1)
+        neighbors, neighbors_quantized = (
+            NearestNeighbors(n_neighbors=n_neighbors + 1).fit(z).kneighbors(z, return_distance=False)[:, 1:]
+            for z in [latent, latent_quantized])
+        report = {
+            'latent_relative_error': float(np.linalg.norm(latent_quantized - latent) / np.linalg.norm(latent)),
+            'neighbors_agreement': float(np.mean([len(np.intersect1d(n, n_q)) / n_neighbors
+                                                  for n, n_q in zip(neighbors, neighbors_quantized)])),
+            'll': lls[0], 'll_quantized': lls[1], 'll_drift': lls[1] - lls[0]}
+        if verbose:
+            print("Quantization report: " + ", ".join("%s %.4f" % item for item in report.items()))
+        return report
+
     @torch.no_grad()
     def get_latent(self, sample=False):
         """
@@ -202,7 +291,7 @@ class Posterior:
         return px_scales, all_labels
 
     @torch.no_grad()
-    def sample_scale_from_batch(self, n_samples, batchid=None, selection=None):
+    def sample_scale_from_batch(self, n_samples, batchid=None, selection=None, genes=None):
         px_scales = []
         if selection is None:
             raise ValueError("selections should be a list of cell subsets indices")
@@ -215,7 +304,7 @@ class Posterior:
             sampler = SubsetRandomSampler(idx)
             self.data_loader_kwargs.update({'sampler': sampler})
             self.data_loader = DataLoader(self.gene_dataset, **self.data_loader_kwargs)
-            px_scales.append(self.get_harmonized_scale(i))
+            px_scales.append(self.get_harmonized_scale(i, genes=genes))
         self.data_loader = old_loader
         px_scales = np.concatenate(px_scales)
         return px_scales
@@ -232,14 +321,16 @@ class Posterior:
             batchid1 = np.arange(self.gene_dataset.n_batches)
         if batchid2 is None:
             batchid2 = np.arange(self.gene_dataset.n_batches)
-        px_scale1 = self.sample_scale_from_batch(selection=idx1, batchid=batchid1, n_samples=n_samples)
-        px_scale2 = self.sample_scale_from_batch(selection=idx2, batchid=batchid2, n_samples=n_samples)
+        # only the requested genes are decoded
+        genes_idx = self.gene_dataset._gene_idx(genes) if genes is not None else None
+        px_scale1 = self.sample_scale_from_batch(selection=idx1, batchid=batchid1, n_samples=n_samples,
+                                                 genes=genes_idx)
+        px_scale2 = self.sample_scale_from_batch(selection=idx2, batchid=batchid2, n_samples=n_samples,
+                                                 genes=genes_idx)
         px_scale_mean1 = px_scale1.mean(axis=0)
         px_scale_mean2 = px_scale2.mean(axis=0)
         px_scale = np.concatenate((px_scale1, px_scale2), axis=0)
         all_labels = np.concatenate((np.repeat(0, len(px_scale1)), np.repeat(1, len(px_scale2))), axis=0)
-        if genes is not None:
-            px_scale = px_scale[:, self.gene_dataset._gene_idx(genes)]
         bayes1 = get_bayes_factors(px_scale, all_labels, cell_idx=0, M_permutation=M_permutation,
                                    permutation=False, sample_pairs=sample_pairs)
         if all_stats is True:
@@ -251,13 +342,18 @@ class Posterior:
                                                 permutation=True, sample_pairs=sample_pairs)
             mean1, mean2, nonz1, nonz2, norm_mean1, norm_mean2 = \
                 self.gene_dataset.raw_counts_properties(idx1, idx2)
+            gene_names = self.gene_dataset.gene_names
+            if genes_idx is not None:
+                mean1, mean2, nonz1, nonz2, norm_mean1, norm_mean2 = (
+                    stat[genes_idx] for stat in (mean1, mean2, nonz1, nonz2, norm_mean1, norm_mean2))
+                gene_names = gene_names[genes_idx]
             res = pd.DataFrame([bayes1, bayes1_permuted, bayes2, bayes2_permuted,
                                 mean1, mean2, nonz1, nonz2, norm_mean1, norm_mean2,
                                 px_scale_mean1, px_scale_mean2],
                                index=['bayes1', 'bayes1_permuted', 'bayes2', 'bayes2_permuted',
                                       'mean1', 'mean2', 'nonz1', 'nonz2', 'norm_mean1', 'norm_mean2',
                                       'scale1', 'scale2'],
-                               columns=self.gene_dataset.gene_names).T
+                               columns=gene_names).T
             res = res.sort_values(by=['bayes1'], ascending=False)
             return res
         else:
@@ -366,10 +462,11 @@ class Posterior:
         original_list = []
         posterior_list = []
         batch_size = 128  # max(self.data_loader_kwargs['batch_size'] // n_samples, 2)  # Reduce batch_size on GPU
+        genes_idx = self.gene_dataset._gene_idx(genes) if genes is not None else None
         for tensors in self.update({"batch_size": batch_size}):
             sample_batch, _, _, batch_index, labels = tensors
             px_dispersion, px_rate = self.model.inference(sample_batch, batch_index=batch_index, y=labels,
-                                                          n_samples=n_samples)[1:3]
+                                                          n_samples=n_samples, genes=genes_idx)[1:3]
 
             p = (px_rate / (px_rate + px_dispersion)).cpu()
             r = px_dispersion.cpu()
@@ -384,8 +481,7 @@ class Posterior:
             posterior_list += [X]
 
             if genes is not None:
-                posterior_list[-1] = posterior_list[-1][:, :, self.gene_dataset._gene_idx(genes)]
-                original_list[-1] = original_list[-1][:, self.gene_dataset._gene_idx(genes)]
+                original_list[-1] = original_list[-1][:, genes_idx]
 
             posterior_list[-1] = np.transpose(posterior_list[-1], (1, 2, 0))
 
@@ -419,22 +515,23 @@ class Posterior:
         return libraries.ravel()
 
     @torch.no_grad()
-    def get_harmonized_scale(self, fixed_batch):
+    def get_harmonized_scale(self, fixed_batch, genes=None):
         px_scales = []
         fixed_batch = float(fixed_batch)
         for tensors in self:
             sample_batch, local_l_mean, local_l_var, batch_index, label = tensors
-            px_scales += [self.model.scale_from_z(sample_batch, fixed_batch).cpu()]
+            px_scales += [self.model.scale_from_z(sample_batch, fixed_batch, genes=genes).cpu()]
         return np.concatenate(px_scales)
 
     @torch.no_grad()
-    def get_sample_scale(self):
+    def get_sample_scale(self, genes=None):
         px_scales = []
+        genes_idx = self.gene_dataset._gene_idx(genes) if genes is not None else None
         for tensors in self:
             sample_batch, _, _, batch_index, labels = tensors
             px_scales += [
                 np.array((self.model.get_sample_scale(
-                    sample_batch, batch_index=batch_index, y=labels, n_samples=1)
+                    sample_batch, batch_index=batch_index, y=labels, n_samples=1, genes=genes_idx)
                          ).cpu())]
         return np.concatenate(px_scales)
 
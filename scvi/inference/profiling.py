@@ -0,0 +1,276 @@
+"""Wall time of the phases of the training loop of a ``Trainer``, and of the submodules of the models"""
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import pandas as pd
+import torch
+
+from scvi.models.classifier import Classifier
+from scvi.models.modules import Decoder, DecoderSCVI, Encoder, FCLayers
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss():
+    r"""Peak resident set size of the process, in MB, or ``None`` if it is not available"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+
+
+class TrainingProfiler:
+    r"""Records the wall time of each phase of the training, per epoch:
+
+        * ``'data'`` - fetching the minibatches from the data loaders
+        * ``'forward'`` - the calls to the model in ``Trainer.loss``, which include the likelihood for the models
+          computing it in their ``forward``
+        * ``'loss'`` - the rest of ``Trainer.loss``
+        * ``'backward'`` - the backward pass
+        * ``'step'`` - the optimizer step (and the gradient all-reduce in distributed training)
+        * ``'epoch_end'`` - ``Trainer.on_epoch_end``, which includes:
+        * ``'metrics'`` - ``Trainer.compute_metrics``
+        * ``'classifier'`` - the classifier sub-training of the ``SemiSupervisedTrainer``
+
+    At the end of each epoch, the time of each phase is appended to ``history['profile_<phase>']``, along with the
+    training throughput in ``history['profile_cells_per_s']`` and the peak RSS of the process in MB in
+    ``history['profile_peak_rss']``.
+
+    :param enabled: If False, the phases are not timed and nothing is recorded
+    :param trace: Whether to keep the events of each phase, for ``save_chrome_trace``
+    :param max_events: Maximal number of events kept, the events beyond being dropped
+    """
+
+    def __init__(self, enabled=True, trace=False, max_events=10 ** 6):
+        self.enabled = enabled
+        self.trace = trace
+        self.max_events = max_events
+        self.events = []
+        self.epochs = []
+        self._epoch_times = defaultdict(float)
+        self._n_cells = 0
+        self._epoch_begin = None
+        self._forward_begin = []
+        self._phases = []
+        self._hooks = []
+        self._origin = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self._phases.append(name)
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, begin, time.perf_counter())
+            self._phases.pop()
+
+    def iterate(self, iterable, name='data'):
+        r"""Iterates over ``iterable``, the time of each ``next`` counting in phase ``name``"""
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            begin = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._record(name, begin, time.perf_counter())
+            yield item
+
+    def attach(self, model):
+        r"""Times the forward calls of ``model`` within phase ``'loss'`` in phase ``'forward'``, until ``detach``"""
+        if self.enabled and not self._hooks:
+            self._hooks = [model.register_forward_pre_hook(self._forward_pre_hook),
+                           model.register_forward_hook(self._forward_hook)]
+
+    def detach(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+
+    def _forward_pre_hook(self, module, inputs):
+        if self._phases and self._phases[-1] == 'loss':
+            self._forward_begin.append(time.perf_counter())
+
+    def _forward_hook(self, module, inputs, outputs):
+        if self._forward_begin and self._phases and self._phases[-1] == 'loss':
+            self._record('forward', self._forward_begin.pop(), time.perf_counter())
+
+    def add_cells(self, n_cells):
+        if self.enabled:
+            self._n_cells += n_cells
+
+    def begin_epoch(self):
+        if self.enabled:
+            self._epoch_times = defaultdict(float)
+            self._n_cells = 0
+            self._epoch_begin = time.perf_counter()
+
+    def end_epoch(self, history):
+        r"""Appends the times of the epoch to ``history``"""
+        if not self.enabled or self._epoch_begin is None:
+            return
+        times = self._epoch_times
+        times['loss'] = max(times['loss'] - times['forward'], 0.)
+        training_time = time.perf_counter() - self._epoch_begin - times['epoch_end']
+        record = {phase: times[phase] for phase in
+                  ['data', 'forward', 'loss', 'backward', 'step', 'epoch_end', 'metrics', 'classifier']}
+        record['cells_per_s'] = self._n_cells / training_time if training_time > 0 else None
+        record['peak_rss'] = peak_rss()
+        for key, value in record.items():
+            history['profile_' + key] += [value]
+        self.epochs += [record]
+        self._epoch_begin = None
+
+    def _record(self, name, begin, end):
+        self._epoch_times[name] += end - begin
+        if self.trace and len(self.events) < self.max_events:
+            self.events += [{'name': name, 'ph': 'X', 'ts': (begin - self._origin) * 1e6,
+                             'dur': (end - begin) * 1e6, 'pid': os.getpid(), 'tid': threading.get_ident()}]
+
+    def save_json(self, path):
+        r"""Saves the per-epoch records to ``path``, as a JSON list"""
+        with open(path, 'w') as f:
+            json.dump(self.epochs, f)
+
+    def save_chrome_trace(self, path):
+        r"""Saves the events of the phases to ``path``, in the Chrome trace format
+        (``chrome://tracing``, Perfetto)"""
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+def _output_bytes(outputs):
+    if isinstance(outputs, torch.Tensor):
+        return outputs.numel() * outputs.element_size()
+    if isinstance(outputs, (list, tuple)):
+        return sum(_output_bytes(output) for output in outputs)
+    return 0
+
+
+class ModuleProfiler:
+    r"""Accumulates, for each submodule of ``model`` of the types ``module_types``, the number of calls, the forward
+    and backward wall times and the bytes of the output tensors of its forward. Times are inclusive: the time of an
+    ``Encoder`` includes the one of its ``FCLayers``. The backward time of a call runs from the first gradient of
+    its outputs to the last gradient of the module parameters, so that it includes the weight gradients of modules
+    whose inputs do not require grad, such as the first layers of the encoders. Hooks are only registered while
+    the profiler is attached, so that a model which is not profiled runs without overhead.
+
+    Examples:
+        >>> with ModuleProfiler(trainer.model) as module_profiler:
+        ...     trainer.train(n_epochs=10)
+        >>> module_profiler.report()
+
+    :param model: The profiled model
+    :param module_types: Types of the profiled submodules
+    :param enabled: If False, ``attach`` registers no hook
+    """
+
+    default_module_types = (Encoder, DecoderSCVI, Decoder, FCLayers, Classifier)
+
+    def __init__(self, model, module_types=None, enabled=True):
+        self.model = model
+        self.module_types = tuple(module_types) if module_types is not None else self.default_module_types
+        self.enabled = enabled
+        self.stats = {}
+        self._hooks = []
+        self._begin = defaultdict(list)
+        self._backward_begin = {}
+        self._backward_end = {}
+
+    def __enter__(self):
+        self.attach()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.detach()
+
+    def attach(self):
+        if not self.enabled or self._hooks:
+            return
+        for name, module in self.model.named_modules():
+            if isinstance(module, self.module_types):
+                self.stats.setdefault(name, {'type': type(module).__name__, 'calls': 0, 'forward_time': 0.,
+                                             'backward_time': 0., 'output_bytes': 0})
+                self._hooks += [
+                    module.register_forward_pre_hook(self._pre_hook(name)),
+                    module.register_forward_hook(self._forward_hook(name)),
+                ]
+                self._hooks += [parameter.register_hook(self._parameter_grad_hook(name))
+                                for parameter in module.parameters() if parameter.requires_grad]
+
+    def detach(self):
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+        for name in list(self._backward_begin):
+            self._end_backward(name)
+        self._begin.clear()
+
+    def reset(self):
+        self.stats = {name: dict(stats, calls=0, forward_time=0., backward_time=0., output_bytes=0)
+                      for name, stats in self.stats.items()}
+
+    def _pre_hook(self, name):
+        def hook(module, args):
+            self._begin[name].append(time.perf_counter())
+        return hook
+
+    def _forward_hook(self, name):
+        def hook(module, inputs, outputs):
+            stats = self.stats[name]
+            stats['forward_time'] += time.perf_counter() - self._begin[name].pop()
+            stats['calls'] += 1
+            stats['output_bytes'] += _output_bytes(outputs)
+            if torch.is_grad_enabled():
+                for output in outputs if isinstance(outputs, (list, tuple)) else [outputs]:
+                    if isinstance(output, torch.Tensor) and output.requires_grad:
+                        output.register_hook(self._output_grad_hook(name))
+        return hook
+
+    def _output_grad_hook(self, name):
+        def hook(grad):
+            if not self._hooks:
+                return
+            if name in self._backward_begin and name in self._backward_end:
+                # the parameter gradients of a previous call are computed: its backward is over
+                self._end_backward(name)
+            self._backward_begin.setdefault(name, time.perf_counter())
+        return hook
+
+    def _parameter_grad_hook(self, name):
+        def hook(grad):
+            if name in self._backward_begin:
+                self._backward_end[name] = time.perf_counter()
+        return hook
+
+    def _end_backward(self, name):
+        begin, end = self._backward_begin.pop(name), self._backward_end.pop(name, None)
+        if end is not None:
+            self.stats[name]['backward_time'] += end - begin
+
+    def report(self):
+        r"""A ``pandas.DataFrame`` with a row per profiled submodule, by decreasing forward time, with its
+        ``type``, number of ``calls``, ``forward_time`` and ``backward_time`` in seconds, and ``output_bytes``"""
+        for name in list(self._backward_end):
+            self._end_backward(name)
+        report = pd.DataFrame.from_dict(self.stats, orient='index',
+                                        columns=['type', 'calls', 'forward_time', 'backward_time', 'output_bytes'])
+        return report.sort_values('forward_time', ascending=False)
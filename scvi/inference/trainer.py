@@ -1,9 +1,13 @@
+import copy
 import logging
+import os
 import sys
 import time
 
 from abc import abstractmethod
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from itertools import cycle
 
 import numpy as np
@@ -13,7 +17,13 @@ from sklearn.model_selection._split import _validate_shuffle_split
 from torch.utils.data.sampler import SubsetRandomSampler
 from tqdm import trange
 
+from scvi.inference.checkpoint import Checkpointer, snapshot
+from scvi.inference.distributed import (
+    all_reduce_gradients, all_reduce_mean, broadcast_buffers, broadcast_flags, broadcast_parameters, get_rank,
+    get_world_size, is_distributed
+)
 from scvi.inference.posterior import Posterior
+from scvi.inference.profiling import TrainingProfiler
 
 logger = logging.getLogger(__name__)
 
@@ -36,14 +46,34 @@ class Trainer:
         :save_best_state_metric:  The statistics on which we keep the network weights achieving the best store, and
             restore them at the end of training. Default: ``None``.
         :on: The data_loader name reference for the ``early_stopping_metric`` and ``save_best_state_metric``, that
-            should be specified if any of them is. Default: ``None``.
+            should be specified if any of them is, or ``'running'`` for the running averages of the training
+            minibatches (``'elbo'``, ``'reconstruction_loss'`` and ``'kl_divergence'``). Default: ``None``.
         :show_progbar: If False, disables progress bar.
+        :mixed_precision: If True, the training steps and the metrics run under a bfloat16 autocast: the linear
+            layers compute in bfloat16, while the likelihood, the KL divergences and the optimizer state remain in
+            float32. Posterior methods can also be run in ``trainer.autocast()``. Default: ``False``.
+        :distributed: If True, trains data-parallel with the other processes of the initialized ``torch.distributed``
+            process group (see ``scvi.inference.distributed.launch``): each rank samples a disjoint shard of the
+            posteriors, the gradients are averaged across ranks, the metrics are averaged over all the shards, and
+            the early stopping decisions are taken by rank 0. Default: ``False``.
+        :checkpoint_kwargs: Keyword arguments of the ``Checkpointer`` writing the checkpoints of the training, from
+            which it can be resumed with ``resume``. Default: no checkpoint.
+        :profile: If True, the wall time of each phase of the training loop is recorded per epoch in ``history``
+            by the ``profiler``, see ``TrainingProfiler``. If ``'trace'``, the events of the phases are also kept,
+            for ``profiler.save_chrome_trace``. Default: ``False``.
+        :async_metrics: If True, the metrics are computed by a background thread on a copy of the model, while the
+            training continues: they reach ``history`` and the early stopping with a lag of up to ``metrics_lag``
+            evaluations, and the best state is the copy on which the best metric was computed. The metrics of the
+            first evaluation are computed synchronously. Default: ``False``.
+        :metrics_lag: Maximal number of pending evaluations with ``async_metrics``, beyond which the training waits
+            for the oldest one. Default: ``1``.
     """
     default_metrics_to_monitor = []
 
     def __init__(self, model, gene_dataset, use_cuda=True, metrics_to_monitor=None, benchmark=False,
                  verbose=False, frequency=None, weight_decay=1e-6, early_stopping_kwargs=dict(),
-                 data_loader_kwargs=dict(), show_progbar=True):
+                 data_loader_kwargs=dict(), show_progbar=True, mixed_precision=False, distributed=False,
+                 checkpoint_kwargs=dict(), profile=False, async_metrics=False, metrics_lag=1):
 
         self.model = model
         self.gene_dataset = gene_dataset
@@ -76,46 +106,145 @@ class Trainer:
 
         self.history = defaultdict(list)
 
-        self.best_state_dict = self.model.state_dict()
+        self.best_state_dict = snapshot(self.model.state_dict())
         self.best_epoch = self.epoch
 
         self.show_progbar = show_progbar
+        self.mixed_precision = mixed_precision
+
+        if distributed and not is_distributed():
+            raise ValueError("distributed training requires an initialized torch.distributed process group")
+        self.distributed = distributed
+        self._shards = dict()
+
+        self.checkpointer = Checkpointer(**checkpoint_kwargs)
+        self._resume_state = None
+
+        self.profiler = TrainingProfiler(enabled=bool(profile), trace=profile == 'trace')
+
+        if async_metrics and distributed:
+            raise ValueError("async_metrics is not supported in distributed training")
+        self.async_metrics = async_metrics
+        self.metrics_lag = metrics_lag
+        self._metrics_executor = None  # started by the first asynchronous evaluation of each train
+        self._pending_metrics = deque()
+
+        self._running_sums = 0
+        self._running_n_cells = 0
+
+    def autocast(self):
+        if not self.mixed_precision:
+            return nullcontext()
+        return torch.autocast('cuda' if self.use_cuda else 'cpu', dtype=torch.bfloat16)
 
     @torch.no_grad()
-    def compute_metrics(self):
+    def compute_metrics(self, update_best_state=True):
+        r"""
+        :param update_best_state: With ``async_metrics``, whether the results of this evaluation can update the best
+         state, which is not the case for the evaluation of the restored best state at the end of the training
+        """
         begin = time.time()
         epoch = self.epoch + 1
         if self.frequency and (epoch == 0 or epoch == self.n_epochs or (epoch % self.frequency == 0)):
-            with torch.set_grad_enabled(False):
-                self.model.eval()
-                if self.verbose:
-                    print("\nEPOCH [%d/%d]: " % (epoch, self.n_epochs))
-
-                for name, posterior in self._posteriors.items():
-                    print_name = ' '.join([s.capitalize() for s in name.split('_')[-2:]])
-                    if hasattr(posterior, 'to_monitor'):
-                        for metric in posterior.to_monitor:
-                            if self.verbose:
-                                print(print_name, end=' : ')
-                            result = getattr(posterior, metric)(verbose=self.verbose)
-                            self.history[metric + '_' + name] += [result]
-                self.model.train()
+            with torch.set_grad_enabled(False), self.profiler.phase('metrics'):
+                if self.async_metrics and epoch != 0:
+                    self._submit_metrics(epoch, update_best_state=update_best_state)
+                else:
+                    self.model.eval()
+                    if self.distributed:
+                        broadcast_buffers(self.model)
+                    posteriors = [(name, self.shard(name)) for name in self._posteriors]
+                    for key, result in self._evaluate_metrics(epoch, posteriors):
+                        self.history[key] += [result]
+                    self.model.train()
+        if self.async_metrics:
+            self._collect_metrics()
         self.compute_metrics_time += time.time() - begin
 
+    @torch.no_grad()
+    def _evaluate_metrics(self, epoch, posteriors):
+        if self.verbose:
+            print("\nEPOCH [%d/%d]: " % (epoch, self.n_epochs))
+        results = []
+        for name, posterior in posteriors:
+            print_name = ' '.join([s.capitalize() for s in name.split('_')[-2:]])
+            if hasattr(posterior, 'to_monitor'):
+                for metric in posterior.to_monitor:
+                    if self.verbose:
+                        print(print_name, end=' : ')
+                    posterior.std_error = None
+                    with self.autocast():
+                        result = getattr(posterior, metric)(verbose=self.verbose)
+                    std_error = posterior.std_error
+                    if self.distributed and result is not None and np.ndim(result) == 0:
+                        n_cells = len(posterior.indices)
+                        result = all_reduce_mean(result, weight=n_cells)
+                        if std_error is not None:
+                            # standard error of the mean over all the shards
+                            std_error = float(np.sqrt(all_reduce_mean(n_cells * std_error ** 2, weight=n_cells) /
+                                                      all_reduce_mean(n_cells) / get_world_size()))
+                    results += [(metric + '_' + name, result)]
+                    if std_error is not None:
+                        results += [(metric + '_' + name + '_std_error', std_error)]
+        return results
+
+    def _submit_metrics(self, epoch, update_best_state=True):
+        self._collect_metrics(max_pending=self.metrics_lag - 1)
+        model = copy.deepcopy(self.model).eval()
+        for module in model.modules():  # the hooks of profilers are not called from the evaluation thread
+            for hooks_name in ['_forward_pre_hooks', '_forward_hooks', '_backward_pre_hooks', '_backward_hooks']:
+                getattr(module, hooks_name, {}).clear()  # no _backward_pre_hooks before torch 2.0
+        posteriors = []
+        for name, posterior in self._posteriors.items():
+            posterior = posterior.update({})
+            posterior.model = model
+            posteriors += [(name, posterior)]
+        if self._metrics_executor is None:
+            self._metrics_executor = ThreadPoolExecutor(max_workers=1)
+        future = self._metrics_executor.submit(self._evaluate_metrics, epoch, posteriors)
+        self._pending_metrics.append((epoch, future, model if update_best_state else None))
+
+    def _collect_metrics(self, max_pending=None):
+        r"""Records the results of the completed evaluations, in order, waiting for the oldest ones until at most
+        ``max_pending`` remain"""
+        pending = self._pending_metrics
+        while pending and ((max_pending is not None and len(pending) > max_pending) or pending[0][1].done()):
+            epoch, future, model = pending.popleft()
+            for key, result in future.result():
+                self.history[key] += [result]
+            on = self.early_stopping.on
+            save_best_state_metric = self.early_stopping.save_best_state_metric
+            if save_best_state_metric is not None and on not in [None, 'running'] and model is not None:
+                if self.early_stopping.update_state(self.history[save_best_state_metric + '_' + on][-1]):
+                    self._update_best_state(model.state_dict(), epoch - 1)
+
     def train(self, n_epochs=20, lr=1e-3, eps=0.01, params=None):
         begin = time.time()
         self.model.train()
 
         if params is None:
             params = filter(lambda p: p.requires_grad, self.model.parameters())
+        params = list(params)
+        if self.distributed:
+            broadcast_parameters(self.model)
 
         optimizer = self.optimizer = torch.optim.Adam(params, lr=lr, eps=eps)  # weight_decay=self.weight_decay,
 
         self.compute_metrics_time = 0
         self.n_epochs = n_epochs
-        self.compute_metrics()
+        if self._resume_state is not None:
+            optimizer.load_state_dict(self._resume_state['optimizer'])
+            self._restore_rng_state(self._resume_state['rng_state'])
+            self._resume_state = None
+            first_epoch = self.epoch + 1
+        else:
+            first_epoch = 0
+            self.compute_metrics()
 
+        profiler = self.profiler
+        profiler.attach(self.model)
         with trange(
+            first_epoch,
             n_epochs,
             desc="training",
             file=sys.stdout,
@@ -125,20 +254,43 @@ class Trainer:
             # See https://stackoverflow.com/questions/42212810/tqdm-in-jupyter-notebook
             for self.epoch in pbar:
                 self.on_epoch_begin()
+                self._running_sums, self._running_n_cells = 0, 0
+                profiler.begin_epoch()
                 pbar.update(1)
-                for tensors_list in self.data_loaders_loop():
-                    loss = self.loss(*tensors_list)
+                for tensors_list in profiler.iterate(self.data_loaders_loop()):
+                    profiler.add_cells(len(tensors_list[0][0]))
+                    with profiler.phase('loss'), self.autocast():
+                        loss = self.loss(*tensors_list)
                     optimizer.zero_grad()
-                    loss.backward()
-                    optimizer.step()
-
-                if not self.on_epoch_end():
+                    with profiler.phase('backward'):
+                        loss.backward()
+                    with profiler.phase('step'):
+                        if self.distributed:
+                            all_reduce_gradients(params)
+                        optimizer.step()
+
+                self._record_running_metrics()
+                with profiler.phase('epoch_end'):
+                    continue_training = self.on_epoch_end()
+                profiler.end_epoch(self.history)
+                if self.checkpointer.due(self.epoch) and get_rank() == 0:
+                    self._collect_metrics(max_pending=0)
+                    self.checkpointer.save(self.checkpoint_state(), self.checkpointer.filename)
+                if not continue_training:
                     break
 
+        self._collect_metrics(max_pending=0)
         if self.early_stopping.save_best_state_metric is not None:
             self.model.load_state_dict(self.best_state_dict)
-            self.compute_metrics()
-
+            self.compute_metrics(update_best_state=False)
+            self._collect_metrics(max_pending=0)
+        if self._metrics_executor is not None:
+            self._metrics_executor.shutdown(wait=True)
+            self._metrics_executor = None
+
+        profiler.detach()
+        if self.checkpointer.enabled:
+            self.checkpointer.wait()
         self.model.eval()
         self.training_time += (time.time() - begin) - self.compute_metrics_time
         if self.verbose and self.frequency:
@@ -152,33 +304,117 @@ class Trainer:
         on = self.early_stopping.on
         early_stopping_metric = self.early_stopping.early_stopping_metric
         save_best_state_metric = self.early_stopping.save_best_state_metric
-        if save_best_state_metric is not None and on is not None:
-            if self.early_stopping.update_state(self.history[save_best_state_metric + '_' + on][-1]):
-                self.best_state_dict = self.model.state_dict()
-                self.best_epoch = self.epoch
+        improved = False
+        # with async_metrics, the best state is updated when the evaluations are collected, except for the
+        # running metrics which are computed synchronously
+        if save_best_state_metric is not None and on is not None and (not self.async_metrics or on == 'running'):
+            improved = self.early_stopping.update_state(self.history[save_best_state_metric + '_' + on][-1])
 
-        continue_training = True
+        continue_training, reduce_lr = True, False
         if early_stopping_metric is not None and on is not None:
+            std_errors = self.history.get(early_stopping_metric + '_' + on + '_std_error')
             continue_training, reduce_lr = self.early_stopping.update(
-                self.history[early_stopping_metric + '_' + on][-1]
+                self.history[early_stopping_metric + '_' + on][-1], std_error=std_errors[-1] if std_errors else None
             )
-            if reduce_lr:
-                # FIXME: replace other print calls
-                logging.info("Reducing LR.")
-                for param_group in self.optimizer.param_groups:
-                    param_group["lr"] *= self.early_stopping.lr_factor
+        if self.distributed:
+            improved, continue_training, reduce_lr = broadcast_flags(improved, continue_training, reduce_lr)
+
+        if improved:
+            self._update_best_state(snapshot(self.model.state_dict()), self.epoch)
+        if reduce_lr:
+            # FIXME: replace other print calls
+            logging.info("Reducing LR.")
+            for param_group in self.optimizer.param_groups:
+                param_group["lr"] *= self.early_stopping.lr_factor
 
         return continue_training
 
+    def record_running_loss(self, reconst_loss, kl_divergence):
+        r"""Accumulates the per-cell reconstruction losses and KL divergences of a training minibatch, computed in
+        ``loss``, in the running averages of the epoch, which are appended at its end to
+        ``history['reconstruction_loss_running']``, ``history['kl_divergence_running']`` and
+        ``history['elbo_running']`` (the negative ELBO, without KL warm-up)"""
+        self._running_sums = self._running_sums + torch.stack(
+            [reconst_loss.detach().float().sum(), kl_divergence.detach().float().sum()])
+        self._running_n_cells += reconst_loss.numel()
+
+    def _record_running_metrics(self):
+        if not self._running_n_cells:
+            return
+        reconstruction_loss, kl_divergence = (self._running_sums / self._running_n_cells).tolist()
+        if self.distributed:
+            reconstruction_loss = all_reduce_mean(reconstruction_loss, weight=self._running_n_cells)
+            kl_divergence = all_reduce_mean(kl_divergence, weight=self._running_n_cells)
+        self.history['reconstruction_loss_running'] += [reconstruction_loss]
+        self.history['kl_divergence_running'] += [kl_divergence]
+        self.history['elbo_running'] += [reconstruction_loss + kl_divergence]
+
+    def _update_best_state(self, state_dict, epoch):
+        self.best_state_dict = state_dict
+        self.best_epoch = epoch
+        if self.checkpointer.enabled and self.checkpointer.save_best and get_rank() == 0:
+            self.checkpointer.save({'model': self.best_state_dict, 'epoch': self.best_epoch},
+                                   self.checkpointer.best_filename, copy=False)
+
+    def checkpoint_state(self):
+        r"""The state of the training at the end of the current epoch: the model and optimizer states, the epoch
+        (hence the position of the KL warm-up), the history, the early stopping state, the best model and the
+        random number generators states"""
+        return {
+            'model': self.model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'epoch': self.epoch,
+            'history': dict(self.history),
+            'early_stopping': dict(vars(self.early_stopping)),
+            'best_state_dict': self.best_state_dict,
+            'best_epoch': self.best_epoch,
+            'rng_state': {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(),
+                          'cuda': torch.cuda.get_rng_state_all() if self.use_cuda else None},
+        }
+
+    def resume(self, path=None, map_location=None):
+        r"""Restores the training state of a checkpoint: the next call to ``train(n_epochs)`` continues the training
+        from the epoch following the checkpoint up to ``n_epochs``, with the optimizer state of the checkpoint.
+
+        :param path: Path of the checkpoint. By default, the training state written by the ``checkpointer``
+        :param map_location: As in ``torch.load``
+        """
+        if path is None:
+            path = os.path.join(self.checkpointer.save_path, self.checkpointer.filename)
+        state = torch.load(path, map_location=map_location, weights_only=False)
+        self.model.load_state_dict(state['model'])
+        self.epoch = state['epoch']
+        self.history = defaultdict(list, state['history'])
+        self.early_stopping.__dict__.update(state['early_stopping'])
+        self.best_state_dict = state['best_state_dict']
+        self.best_epoch = state['best_epoch']
+        self._resume_state = state
+
+    def _restore_rng_state(self, rng_state):
+        torch.set_rng_state(rng_state['torch'])
+        np.random.set_state(rng_state['numpy'])
+        if self.use_cuda and rng_state['cuda'] is not None:
+            torch.cuda.set_rng_state_all(rng_state['cuda'])
+
     @property
     @abstractmethod
     def posteriors_loop(self):
         pass
 
     def data_loaders_loop(self):  # returns an zipped iterable corresponding to loss signature
-        data_loaders_loop = [self._posteriors[name] for name in self.posteriors_loop]
+        data_loaders_loop = [self.shard(name) for name in self.posteriors_loop]
         return zip(data_loaders_loop[0], *[cycle(data_loader) for data_loader in data_loaders_loop[1:]])
 
+    def shard(self, name):
+        r"""The posterior ``name``, or in distributed training, its shard for this rank, which is cached until
+        the posterior is replaced"""
+        posterior = self._posteriors[name]
+        if not self.distributed:
+            return posterior
+        if name not in self._shards or self._shards[name][0] is not posterior:
+            self._shards[name] = (posterior, posterior.shard())
+        return self._shards[name][1]
+
     def register_posterior(self, name, value):
         name = name.strip('_')
         self._posteriors[name] = value
@@ -247,6 +483,16 @@ class SequentialSubsetSampler(SubsetRandomSampler):
         return iter(self.indices)
 
 
+def metric_mode(metric, on=None):
+    r"""``'min'`` or ``'max'``, the optimization mode of ``metric``, computed on the posterior ``on``, or over the
+    training minibatches if ``on`` is ``'running'``"""
+    if on == 'running':
+        if metric not in ['elbo', 'reconstruction_loss', 'kl_divergence']:
+            raise ValueError("Unknown running metric %s" % metric)
+        return 'min'
+    return getattr(Posterior, metric).mode
+
+
 class EarlyStopping:
     def __init__(
         self,
@@ -259,14 +505,20 @@ class EarlyStopping:
         reduce_lr_on_plateau: bool = False,
         lr_patience: int = 10,
         lr_factor: float = 0.5,
+        threshold_std_errors: float = None,
     ):
+        """
+        :param threshold_std_errors: If not ``None``, an improvement of the ``early_stopping_metric`` is significant
+         if it exceeds this number of standard errors of the metric, for metrics reporting their ``std_error``
+         (see ``Posterior.subsample``), instead of ``threshold``
+        """
         self.benchmark = benchmark
         self.patience = patience
         self.threshold = threshold
         self.epoch = 0
         self.wait = 0
         self.wait_lr = 0
-        self.mode = getattr(Posterior, early_stopping_metric).mode if early_stopping_metric is not None else None
+        self.mode = metric_mode(early_stopping_metric, on) if early_stopping_metric is not None else None
         # We set the best to + inf because we're dealing with a loss we want to minimize
         self.current_performance = np.inf
         self.best_performance = np.inf
@@ -275,8 +527,8 @@ class EarlyStopping:
         if self.mode == "max":
             self.best_performance *= -1
             self.current_performance *= -1
-        self.mode_save_state = getattr(Posterior,
-                                       save_best_state_metric).mode if save_best_state_metric is not None else None
+        self.mode_save_state = (metric_mode(save_best_state_metric, on) if save_best_state_metric is not None
+                                else None)
         if self.mode_save_state == "max":
             self.best_performance_state *= -1
 
@@ -286,9 +538,13 @@ class EarlyStopping:
         self.reduce_lr_on_plateau = reduce_lr_on_plateau
         self.lr_patience = lr_patience
         self.lr_factor = lr_factor
+        self.threshold_std_errors = threshold_std_errors
 
-    def update(self, scalar):
+    def update(self, scalar, std_error=None):
         self.epoch += 1
+        threshold = self.threshold
+        if self.threshold_std_errors is not None and std_error is not None:
+            threshold = self.threshold_std_errors * std_error
         if self.benchmark:
             continue_training = True
             reduce_lr = False
@@ -319,7 +575,7 @@ class EarlyStopping:
             if improvement > 0:
                 self.best_performance = self.current_performance
 
-            if improvement < self.threshold:
+            if improvement < threshold:
                 self.wait += 1
                 self.wait_lr += 1
             else:
@@ -329,7 +585,7 @@ class EarlyStopping:
             continue_training = True
         if not continue_training:
             # FIXME: use logging and log total number of epochs run
-            print("\nStopping early: no improvement of more than " + str(self.threshold) +
+            print("\nStopping early: no improvement of more than " + str(threshold) +
                   " nats in " + str(self.patience) + " epochs")
             print("If the early stopping criterion is too strong, "
                   "please instantiate it with different parameters in the train method.")
@@ -13,4 +13,5 @@ class Classifier(nn.Module):
         )
 
     def forward(self, x):
-        return self.classifier(x)
+        # logits are cast to float32 before the softmax, as under a bfloat16 autocast
+        return self.classifier[-1](self.classifier[:-1](x).float())
@@ -0,0 +1,86 @@
+"""Export of the inference graph of trained models to TorchScript, for serving without the scvi model classes"""
+
+import copy
+import json
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn as nn
+
+from scvi.models.quantization import fold_batch_norm
+from scvi.models.utils import log1p
+
+
+class EncoderGraph(nn.Module):
+    r"""Inference graph of a trained model: from raw counts to the mean of the posterior of z,
+    and to the label probabilities if ``classify``.
+
+    :param model: A trained ``VAE``, ``LDVAE`` or ``SCANVI``
+    :param gene_index: For each gene of the model, its column in the input, or the number of columns of the
+        input if it is missing (its counts are then zero). ``None`` if the input columns are the genes of the model
+    :param classify: Whether to also return the label probabilities, for models with a ``classify_latent`` method
+    """
+
+    def __init__(self, model, gene_index=None, classify=False):
+        super().__init__()
+        self.model = model
+        self.classify = classify
+        self.register_buffer('gene_index', torch.as_tensor(gene_index, dtype=torch.long)
+                             if gene_index is not None else None)
+
+    def forward(self, x):
+        if self.gene_index is not None:
+            x = F.pad(x, (0, 1))[:, self.gene_index]
+        if self.model.log_variational:
+            x = log1p(x)
+        z = self.model.z_encoder.encode_mean(x)
+        if self.classify:
+            return z, self.model.classify_latent(z)
+        return z
+
+
+def export_encoder(model, path, gene_names=None, model_gene_names=None, classify=False):
+    r"""Traces the inference graph (``EncoderGraph``) of ``model`` on CPU, with its BatchNorm folded into the
+    preceding layers, and saves it as a TorchScript archive, which can be loaded with ``torch.jit.load`` alone,
+    or with ``load_encoder``.
+
+    :param model: A trained ``VAE``, ``LDVAE`` or ``SCANVI``
+    :param path: Path of the archive
+    :param gene_names: Genes of the columns of the inputs that will be served, in order.
+        By default, the genes of the model
+    :param model_gene_names: Genes of the model (``gene_dataset.gene_names``), required with ``gene_names``
+    :param classify: Whether the archive also outputs the label probabilities (``SCANVI``)
+    :return: The traced module
+    """
+    gene_index = None
+    if gene_names is not None:
+        if model_gene_names is None:
+            raise ValueError("model_gene_names are required to reindex the genes of the inputs")
+        columns = {gene_name: i for i, gene_name in enumerate(gene_names)}
+        gene_index = [columns.get(gene_name, len(gene_names)) for gene_name in model_gene_names]
+    model = fold_batch_norm(copy.deepcopy(model).cpu().eval())
+    graph = EncoderGraph(model, gene_index=gene_index, classify=classify).eval()
+    n_input = len(gene_names) if gene_names is not None else model.z_encoder.encoder.fc_layers[0][0].in_features
+    with torch.no_grad():
+        traced = torch.jit.trace(graph, torch.ones(2, n_input))
+    metadata = {'gene_names': [str(gene_name) for gene_name in np.asarray(gene_names)]
+                if gene_names is not None else None,
+                'n_latent': model.n_latent,
+                'classify': classify}
+    torch.jit.save(traced, path, _extra_files={'metadata.json': json.dumps(metadata)})
+    return traced
+
+
+def load_encoder(path, map_location='cpu'):
+    r"""Loads an archive saved by ``export_encoder``.
+
+    :param path: Path of the archive
+    :param map_location: Device of the loaded module
+    :return: The module, mapping a ``(batch_size, n_genes)`` float tensor of counts to the latent means
+        (and the label probabilities), and a dict of metadata with the ``gene_names`` of the input columns
+        (``None`` for the genes of the model), ``n_latent`` and ``classify``
+    """
+    extra_files = {'metadata.json': ''}
+    module = torch.jit.load(path, map_location=map_location, _extra_files=extra_files)
+    return module, json.loads(extra_files['metadata.json'])
@@ -4,50 +4,75 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import logsumexp
-from torch.distributions import Normal
 
+from scvi.models.utils import log_normal
 
-def compute_log_likelihood(vae, posterior, **kwargs):
+
+def compute_log_likelihood(vae, posterior, return_std_error=False, **kwargs):
     """ Computes log p(x/z), which is the reconstruction error .
         Differs from the marginal log likelihood, but still gives good
         insights on the modeling of the data, and is fast to compute
+        If ``return_std_error``, also returns the standard error of this mean over the cells
     """
     # Iterate once over the posterior and computes the total log_likelihood
     log_lkl = 0
+    log_lkl_squares = 0
     for i_batch, tensors in enumerate(posterior):
         sample_batch, local_l_mean, local_l_var, batch_index, labels = tensors[:5]  # general fish case
         reconst_loss, kl_divergence = vae(sample_batch, local_l_mean, local_l_var, batch_index=batch_index,
                                           y=labels, **kwargs)
         log_lkl += torch.sum(reconst_loss).item()
+        log_lkl_squares += torch.sum(reconst_loss.double() ** 2).item()
     n_samples = len(posterior.indices)
+    if return_std_error:
+        mean = log_lkl / n_samples
+        variance = max(log_lkl_squares / n_samples - mean ** 2, 0) * n_samples / max(n_samples - 1, 1)
+        return mean, float(np.sqrt(variance / n_samples))
     return log_lkl / n_samples
 
 
-def compute_marginal_log_likelihood(vae, posterior, n_samples_mc=100):
-    """ Computes a biased estimator for log p(x), which is the marginal log likelihood.
+@torch.no_grad()
+def compute_marginal_log_likelihood(vae, posterior, n_samples_mc=100, memory_budget=2 ** 28, tol=None,
+                                    min_samples_mc=100):
+    """ Computes an importance sampling estimator of log p(x), which is the marginal log likelihood,
+        with the variational posterior q(z, l | x) as proposal.
         Despite its bias, the estimator still converges to the real value
         of log p(x) when n_samples_mc (for Monte Carlo) goes to infinity
         (a fairly high value like 100 should be enough)
-        Due to the Monte Carlo sampling, this method is not as computationally efficient
-        as computing only the reconstruction loss
+        For each minibatch, the samples are drawn in chunks of (samples x cells) sized to ``memory_budget``
+        (in bytes), each decoded in a single pass, and the importance weights are accumulated with a
+        streaming log-sum-exp. If ``tol`` is given, the sampling of a minibatch stops as soon as the
+        (delta method) standard error of its mean estimate of log p(x) drops below ``tol``, which is only
+        checked once ``min_samples_mc`` samples are drawn as it is underestimated with few samples.
     """
-    # Uses MC sampling to compute a tighter lower bound
     log_lkl = 0
     for i_batch, tensors in enumerate(posterior):
         sample_batch, local_l_mean, local_l_var, batch_index, labels = tensors
-        x = torch.log(1 + sample_batch)
-        to_sum = torch.zeros(sample_batch.size()[0], n_samples_mc)
-        for i in range(n_samples_mc):
-            qz_m, qz_v, z = vae.z_encoder(x, labels)
-            reconst_loss, kl_divergence = vae(sample_batch, local_l_mean,
-                                              local_l_var,
-                                              batch_index=batch_index,
-                                              y=labels)
-            p_z = Normal(torch.zeros_like(qz_m), torch.ones_like(qz_v)).log_prob(z).sum(dim=-1)
-            p_x_z = - reconst_loss
-            q_z_x = Normal(qz_m, qz_v.sqrt()).log_prob(z).sum(dim=-1)
-            to_sum[:, i] = p_z + p_x_z - q_z_x
-        batch_log_lkl = logsumexp(to_sum, dim=-1) - np.log(n_samples_mc)
+        n_cells, n_genes = sample_batch.size()
+        # about ten (samples x cells x genes) float tensors are alive at once in the decoder and the likelihood
+        chunk_size = int(max(1, min(n_samples_mc, memory_budget // (10 * 4 * n_cells * n_genes))))
+        log_sum_w = torch.full((n_cells,), -float('inf'), device=sample_batch.device)
+        log_sum_w2 = torch.full((n_cells,), -float('inf'), device=sample_batch.device)
+        n_drawn = 0
+        while n_drawn < n_samples_mc:
+            n_chunk = min(chunk_size, n_samples_mc - n_drawn)
+            px_scale, px_r, px_rate, px_dropout, qz_m, qz_v, z, ql_m, ql_v, library = \
+                vae.inference(sample_batch, batch_index, labels, n_samples=n_chunk)
+            p_x_zl = - vae._reconstruction_loss(sample_batch, px_rate, px_r, px_dropout)
+            p_z = log_normal(z).sum(dim=-1)
+            p_l = log_normal(library, local_l_mean, local_l_var).sum(dim=-1)
+            q_z_x = log_normal(z, qz_m, qz_v).sum(dim=-1)
+            q_l_x = log_normal(library, ql_m, ql_v).sum(dim=-1)
+            log_w = (p_x_zl + p_z + p_l - q_z_x - q_l_x).view(-1, n_cells)
+            log_sum_w = torch.logaddexp(log_sum_w, logsumexp(log_w, dim=0))
+            log_sum_w2 = torch.logaddexp(log_sum_w2, logsumexp(2 * log_w, dim=0))
+            n_drawn += n_chunk
+            if tol is not None and min_samples_mc <= n_drawn < n_samples_mc:
+                # relative variance of the weights, var(w) / mean(w) ** 2, gives the variance of log mean(w)
+                relative_var = torch.expm1(log_sum_w2 - 2 * log_sum_w + np.log(n_drawn)).clamp(min=0)
+                if (relative_var.sum() / n_drawn).sqrt().item() / n_cells < tol:
+                    break
+        batch_log_lkl = log_sum_w - np.log(n_drawn)
         log_lkl += torch.sum(batch_log_lkl).item()
     n_samples = len(posterior.indices)
     # The minus sign is there because we actually look at the negative log likelihood
@@ -115,3 +140,175 @@ def log_nb_positive(x, mu, theta, eps=1e-8):
         torch.lgamma(x + 1)
 
     return torch.sum(res, dim=-1)
+
+
+class _LogZINBPositive(torch.autograd.Function):
+    r"""Fused ``log_zinb_positive``: only the inputs are saved for backward, where the gradients are
+    computed in closed form, instead of the dozen (cells x genes) temporaries recorded by autograd.
+    """
+
+    @staticmethod
+    def forward(ctx, x, mu, theta, pi, eps):
+        ctx.save_for_backward(x, mu, theta, pi)
+        ctx.eps = eps
+        softplus_pi = F.softplus(-pi)
+        log_theta_mu_eps = torch.log(theta + mu + eps)
+        pi_theta_log = theta * (torch.log(theta + eps) - log_theta_mu_eps) - pi
+
+        case_zero = F.softplus(pi_theta_log) - softplus_pi
+        case_non_zero = torch.log(mu + eps).sub_(log_theta_mu_eps).mul_(x)
+        del log_theta_mu_eps
+        case_non_zero = case_non_zero.add_(pi_theta_log).sub_(softplus_pi) + \
+            torch.lgamma(x + theta) - torch.lgamma(theta) - torch.lgamma(x + 1)
+        res = torch.where(x < eps, case_zero, torch.where(x > eps, case_non_zero, torch.zeros_like(case_non_zero)))
+        return torch.sum(res, dim=-1)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, mu, theta, pi = ctx.saved_tensors
+        eps = ctx.eps
+        grad_output = grad_output.unsqueeze(-1)
+        theta_mu_eps = theta + mu + eps
+        log_theta_eps_mu_eps = torch.log(theta + eps) - torch.log(theta_mu_eps)
+        sigmoid_pi_theta_log = torch.sigmoid(theta * log_theta_eps_mu_eps - pi)
+        case_zero, case_non_zero = x < eps, x > eps
+        zeros = torch.zeros((), dtype=mu.dtype, device=mu.device)
+
+        grad_mu = grad_theta = grad_pi = None
+        if ctx.needs_input_grad[1]:
+            d_pi_theta_log = - theta / theta_mu_eps
+            grad_mu = torch.where(case_zero, sigmoid_pi_theta_log * d_pi_theta_log,
+                                  torch.where(case_non_zero, d_pi_theta_log + x / (mu + eps) - x / theta_mu_eps,
+                                              zeros))
+            grad_mu = (grad_output * grad_mu).sum_to_size(mu.size())
+        if ctx.needs_input_grad[2]:
+            d_pi_theta_log = log_theta_eps_mu_eps + theta / (theta + eps) - theta / theta_mu_eps
+            grad_theta = torch.where(case_zero, sigmoid_pi_theta_log * d_pi_theta_log,
+                                     torch.where(case_non_zero,
+                                                 d_pi_theta_log - x / theta_mu_eps +
+                                                 torch.digamma(x + theta) - torch.digamma(theta), zeros))
+            grad_theta = (grad_output * grad_theta).sum_to_size(theta.size())
+        if ctx.needs_input_grad[3]:
+            grad_pi = torch.where(case_zero, torch.sigmoid(-pi) - sigmoid_pi_theta_log,
+                                  torch.where(case_non_zero, - torch.sigmoid(pi), zeros))
+            grad_pi = (grad_output * grad_pi).sum_to_size(pi.size())
+        return None, grad_mu, grad_theta, grad_pi, None
+
+
+class _LogNBPositive(torch.autograd.Function):
+    r"""Fused ``log_nb_positive``, see ``_LogZINBPositive``.
+    """
+
+    @staticmethod
+    def forward(ctx, x, mu, theta, eps):
+        ctx.save_for_backward(x, mu, theta)
+        ctx.eps = eps
+        log_theta_mu_eps = torch.log(theta + mu + eps)
+        res = torch.log(mu + eps).sub_(log_theta_mu_eps).mul_(x) + \
+            theta * (torch.log(theta + eps) - log_theta_mu_eps)
+        del log_theta_mu_eps
+        res = res.add_(torch.lgamma(x + theta)).sub_(torch.lgamma(theta)) - torch.lgamma(x + 1)
+        return torch.sum(res, dim=-1)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, mu, theta = ctx.saved_tensors
+        eps = ctx.eps
+        grad_output = grad_output.unsqueeze(-1)
+        theta_mu_eps = theta + mu + eps
+
+        grad_mu = grad_theta = None
+        if ctx.needs_input_grad[1]:
+            grad_mu = x / (mu + eps) - (theta + x) / theta_mu_eps
+            grad_mu = (grad_output * grad_mu).sum_to_size(mu.size())
+        if ctx.needs_input_grad[2]:
+            grad_theta = torch.log(theta + eps) - torch.log(theta_mu_eps) + theta / (theta + eps) - \
+                (theta + x) / theta_mu_eps + torch.digamma(x + theta) - torch.digamma(theta)
+            grad_theta = (grad_output * grad_theta).sum_to_size(theta.size())
+        return None, grad_mu, grad_theta, None
+
+
+def log_zinb_positive_fused(x, mu, theta, pi, eps=1e-8):
+    """
+    Same as ``log_zinb_positive``, with a hand-derived backward pass which recomputes the intermediate
+    terms rather than storing them: peak memory of a training step is several (minibatch x genes)
+    tensors lower. No gradient is computed for ``x``.
+    """
+    if theta.ndimension() == 1:
+        theta = theta.view(1, theta.size(0))  # In this case, we reshape theta for broadcasting
+    return _LogZINBPositive.apply(x, mu, theta, pi, eps)
+
+
+def log_nb_positive_fused(x, mu, theta, eps=1e-8):
+    """
+    Same as ``log_nb_positive``, with a hand-derived backward pass (see ``log_zinb_positive_fused``).
+    """
+    if theta.ndimension() == 1:
+        theta = theta.view(1, theta.size(0))  # In this case, we reshape theta for broadcasting
+    return _LogNBPositive.apply(x, mu, theta, eps)
+
+
+def _nonzero_entries(x, *params):
+    """
+    Returns the (cell, gene) coordinates of the nonzero counts of ``x`` (dense, or sparse COO tensor),
+    their values, and ``params`` gathered at these coordinates (after broadcasting, shape ``(..., nnz)``).
+    """
+    if x.is_sparse:
+        x = x.coalesce()
+        (rows, cols), values = x.indices(), x.values()
+    else:
+        rows, cols = torch.nonzero(x, as_tuple=True)
+        values = x[rows, cols]
+    shape = torch.broadcast_shapes(*(param.size() for param in params))
+    return rows, values, [param.expand(shape)[..., rows, cols] for param in params]
+
+
+def log_zinb_positive_sparse(x, mu, theta, pi, eps=1e-8):
+    """
+    Same as ``log_zinb_positive``, for sparse ``x`` (dense tensor or sparse COO tensor of counts): the zero
+    case is evaluated over all entries, and the count dependent terms (among which three ``lgamma``)
+    only at the nonzero entries of ``x``, as a correction of the zero case.
+    """
+    if theta.ndimension() == 1:
+        theta = theta.view(1, theta.size(0))  # In this case, we reshape theta for broadcasting
+
+    res = torch.sum(F.softplus(- pi + theta * (torch.log(theta + eps) - torch.log(theta + mu + eps))) -
+                    F.softplus(-pi), dim=-1)
+
+    rows, x, (mu, theta, pi) = _nonzero_entries(x, mu, theta, pi)
+    log_theta_mu_eps = torch.log(theta + mu + eps)
+    pi_theta_log = - pi + theta * (torch.log(theta + eps) - log_theta_mu_eps)
+    case_non_zero = pi_theta_log + \
+        x * (torch.log(mu + eps) - log_theta_mu_eps) + \
+        torch.lgamma(x + theta) - \
+        torch.lgamma(theta) - \
+        torch.lgamma(x + 1)
+    # the softplus(-pi) terms are common to both cases
+    correction = case_non_zero - F.softplus(pi_theta_log)
+    return res.index_add(res.dim() - 1, rows, correction)
+
+
+def log_nb_positive_sparse(x, mu, theta, eps=1e-8):
+    """
+    Same as ``log_nb_positive``, only evaluating the count dependent terms at the nonzero entries of ``x``
+    (see ``log_zinb_positive_sparse``).
+    """
+    if theta.ndimension() == 1:
+        theta = theta.view(1, theta.size(0))  # In this case, we reshape theta for broadcasting
+
+    res = torch.sum(theta * (torch.log(theta + eps) - torch.log(theta + mu + eps)), dim=-1)
+
+    rows, x, (mu, theta) = _nonzero_entries(x, mu, theta)
+    correction = x * (torch.log(mu + eps) - torch.log(theta + mu + eps)) + \
+        torch.lgamma(x + theta) - \
+        torch.lgamma(theta) - \
+        torch.lgamma(x + 1)
+    return res.index_add(res.dim() - 1, rows, correction)
+
+
+# (zinb, nb) log likelihoods for each value of the ``likelihood_kernel`` attribute of the models
+likelihood_kernels = {
+    'standard': (log_zinb_positive, log_nb_positive),
+    'fused': (log_zinb_positive_fused, log_nb_positive_fused),
+    'sparse': (log_zinb_positive_sparse, log_nb_positive_sparse),
+}
@@ -2,10 +2,10 @@ import collections
 from typing import Iterable
 
 import torch
+import torch.nn.functional as F
 from torch import nn as nn
-from torch.distributions import Normal
 
-from scvi.models.utils import one_hot
+from scvi.models.utils import one_hot, reparameterize
 
 
 class FCLayers(nn.Module):
@@ -19,11 +19,21 @@ class FCLayers(nn.Module):
     :param n_layers: The number of fully-connected hidden layers
     :param n_hidden: The number of nodes per hidden layer
     :param dropout_rate: Dropout rate to apply to each of the hidden layers
+    :param covariate_injection: One of
+
+        * ``'embedding'`` - the columns of the weights of each ``nn.Linear`` corresponding to the one-hot
+          encoding of the categories are gathered and added to the output, as a per-category bias
+        * ``'one_hot'`` - one-hot encodings are concatenated to the input of each ``nn.Linear``
+
+        Both are equivalent and use the same parameters.
     """
 
     def __init__(self, n_in: int, n_out: int, n_cat_list: Iterable[int] = None,
-                 n_layers: int = 1, n_hidden: int = 128, dropout_rate: float = 0.1, use_batch_norm=True):
+                 n_layers: int = 1, n_hidden: int = 128, dropout_rate: float = 0.1, use_batch_norm=True,
+                 covariate_injection: str = 'embedding'):
         super().__init__()
+        self.covariate_injection = covariate_injection
+        self._folded = None  # cache of the eval mode layers, see _folded_layers
         layers_dim = [n_in] + (n_layers - 1) * [n_hidden] + [n_out]
 
         if n_cat_list is not None:
@@ -47,11 +57,115 @@ class FCLayers(nn.Module):
     def forward(self, x: torch.Tensor, *cat_list: int):
         r"""Forward computation on ``x``.
 
-        :param x: tensor of values with shape ``(n_in,)``
+        :param x: tensor of values with shape ``(n_in,)``, or a sparse COO tensor
         :param cat_list: list of category membership(s) for this sample
         :return: tensor of shape ``(n_out,)``
         :rtype: :py:class:`torch.Tensor`
         """
+        if self.covariate_injection == 'one_hot':
+            return self._forward_one_hot(x, *cat_list)
+        assert len(self.n_cat_list) <= len(cat_list), "nb. categorical args provided doesn't match init. params."
+        covariates = []  # (offset of the category columns in the weights, indices or one-hot encoding)
+        offset, n_rows = 0, x.size(0)
+        for n_cat, cat in zip(self.n_cat_list, cat_list):
+            assert not (n_cat and cat is None), "cat not provided while n_cat != 0 in init. params."
+            if n_cat > 1:  # n_cat = 1 will be ignored - no additional information
+                if cat.size(1) != n_cat:
+                    covariates += [(offset, n_cat, cat.view(-1).long(), None)]
+                else:
+                    covariates += [(offset, n_cat, None, cat)]  # cat has already been one_hot encoded
+                offset += n_cat
+                n_rows = max(n_rows, cat.size(0))
+        # Categories can enumerate several values for each row of x, as (n_values * n_rows_x) rows ordered by value:
+        # the x dependent part of the first layer is then computed once, and repeated for each value
+        n_repeats = n_rows // x.size(0) if x.dim() == 2 else 1
+        folded_layers = self._folded_layers() if not (self.training or torch.is_grad_enabled() or
+                                                      torch.jit.is_tracing()) else None
+        if folded_layers is not None:
+            for weight, bias in folded_layers:
+                n_x = weight.size(1) - offset
+                x = self._linear(x, weight[:, :n_x], bias)
+                if n_repeats > 1:
+                    x, n_repeats = x.repeat(n_repeats, 1), 1
+                for cat_offset, n_cat, index, one_hot_cat in covariates:
+                    cat_weight = weight[:, n_x + cat_offset:n_x + cat_offset + n_cat]
+                    x = x + (cat_weight.t()[index] if index is not None else F.linear(one_hot_cat, cat_weight))
+                x = F.relu(x)
+            return x
+        for layers in self.fc_layers:
+            for layer in layers:
+                if layer is not None:
+                    if isinstance(layer, nn.BatchNorm1d):
+                        x = self._batch_norm(layer, x)
+                    elif isinstance(layer, nn.Linear) and (covariates or x.is_sparse):
+                        n_x = layer.in_features - offset
+                        x = self._linear(x, layer.weight[:, :n_x], layer.bias)
+                        if n_repeats > 1:
+                            x, n_repeats = x.repeat(n_repeats, 1), 1
+                        for cat_offset, n_cat, index, one_hot_cat in covariates:
+                            weight = layer.weight[:, n_x + cat_offset:n_x + cat_offset + n_cat]
+                            # (n_batch, n_out) per-category bias, broadcast along the sample dimension if any
+                            x = x + (weight.t()[index] if index is not None else F.linear(one_hot_cat, weight))
+                    elif hasattr(layer, 'in_features') and (covariates or x.is_sparse):
+                        # linear layer without weight tensor (dynamically quantized): one-hot encodings are
+                        # concatenated to its input
+                        x = x.to_dense() if x.is_sparse else x
+                        if n_repeats > 1:
+                            x, n_repeats = x.repeat(n_repeats, 1), 1
+                        one_hot_cats = [one_hot_cat if index is None else one_hot(index.view(-1, 1), n_cat)
+                                        for _, n_cat, index, one_hot_cat in covariates]
+                        if x.dim() == 3:
+                            one_hot_cats = [o.unsqueeze(0).expand((x.size(0),) + o.size()) for o in one_hot_cats]
+                        x = layer(torch.cat((x, *one_hot_cats), dim=-1))
+                    else:
+                        x = layer(x)
+        return x
+
+    def _folded_layers(self):
+        r"""Eval mode computations as a flat list of ``(weight, bias)`` of the linear layers, each followed by a
+        ReLU: the BatchNorm statistics are folded into the weights, and Dropout is a no-op. The list is cached
+        until a parameter or buffer is modified in place (e.g. by an optimizer step) or replaced.
+        Returns ``None`` if the layers cannot be folded (e.g. quantized, or one-hot covariate injection).
+        """
+        tensors = list(self.parameters()) + list(self.buffers())
+        key = tuple((t.data_ptr(), t._version) for t in tensors)
+        if self._folded is not None and self._folded[0] == key:
+            return self._folded[1]
+        folded_layers = []
+        for layers in self.fc_layers:
+            linear, batch_norm = layers[0], layers[1]
+            if self.covariate_injection != 'embedding' or not isinstance(linear, nn.Linear):
+                return None
+            weight, bias = linear.weight, linear.bias
+            if batch_norm is not None:
+                if not batch_norm.track_running_stats:
+                    return None
+                scale = batch_norm.weight / torch.sqrt(batch_norm.running_var + batch_norm.eps)
+                weight, bias = weight * scale.unsqueeze(1), (bias - batch_norm.running_mean) * scale + batch_norm.bias
+            folded_layers += [(weight, bias)]
+        self._folded = (key, folded_layers)
+        return folded_layers
+
+    @staticmethod
+    def _linear(x: torch.Tensor, weight: torch.Tensor, bias: torch.Tensor):
+        if x.is_sparse:
+            # sparse-dense product: the cost of the first layer scales with the number of nonzero entries of x
+            return torch.sparse.mm(x, weight.t()) + bias
+        return F.linear(x, weight, bias)
+
+    @staticmethod
+    def _batch_norm(layer: nn.BatchNorm1d, x: torch.Tensor):
+        if x.dim() == 3:
+            if layer.training or not layer.track_running_stats:
+                # batch statistics are computed (and running statistics updated) independently for each sample
+                return torch.cat([(layer(slice_x)).unsqueeze(0) for slice_x in x], dim=0)
+            # running statistics make the normalization elementwise: samples x cells form a single batch
+            return layer(x.reshape(-1, x.size(-1))).view(x.size())
+        return layer(x)
+
+    def _forward_one_hot(self, x: torch.Tensor, *cat_list: int):
+        if x.is_sparse:
+            x = x.to_dense()
         one_hot_cat_list = []  # for generality in this list many indices useless.
         assert len(self.n_cat_list) <= len(cat_list), "nb. categorical args provided doesn't match init. params."
         for n_cat, cat in zip(self.n_cat_list, cat_list):
@@ -66,10 +180,7 @@ class FCLayers(nn.Module):
             for layer in layers:
                 if layer is not None:
                     if isinstance(layer, nn.BatchNorm1d):
-                        if x.dim() == 3:
-                            x = torch.cat([(layer(slice_x)).unsqueeze(0) for slice_x in x], dim=0)
-                        else:
-                            x = layer(x)
+                        x = self._batch_norm(layer, x)
                     else:
                         if isinstance(layer, nn.Linear):
                             if x.dim() == 3:
@@ -80,6 +191,17 @@ class FCLayers(nn.Module):
         return x
 
 
+def linear_genes(layer: nn.Linear, x: torch.Tensor, genes: torch.Tensor = None):
+    r"""Applies the ``nn.Linear`` ``layer`` restricted to the output features (genes) of index ``genes``,
+    or to all of them if ``None``.
+    """
+    if genes is None:
+        return layer(x)
+    if not isinstance(layer, nn.Linear):  # without weight tensor (dynamically quantized)
+        return layer(x)[..., torch.as_tensor(genes, device=x.device)]
+    return F.linear(x, layer.weight[genes], layer.bias[genes] if layer.bias is not None else None)
+
+
 # Encoder
 class Encoder(nn.Module):
     r"""Encodes data of ``n_input`` dimensions into a latent space of ``n_output``
@@ -106,7 +228,7 @@ class Encoder(nn.Module):
         self.var_encoder = nn.Linear(n_hidden, n_output)
 
     def reparameterize(self, mu, var):
-        return Normal(mu, var.sqrt()).rsample()
+        return reparameterize(mu, var)
 
     def forward(self, x: torch.Tensor, *cat_list: int):
         r"""The forward computation for a single sample.
@@ -123,11 +245,23 @@ class Encoder(nn.Module):
 
         # Parameters for latent distribution
         q = self.encoder(x, *cat_list)
-        q_m = self.mean_encoder(q)
-        q_v = torch.exp(self.var_encoder(q))
+        # heads are cast to float32, for the sampling and the KL divergence under a bfloat16 autocast
+        q_m = self.mean_encoder(q).float()
+        q_v = torch.exp(self.var_encoder(q).float())
         latent = self.reparameterize(q_m, q_v)
         return q_m, q_v, latent
 
+    def encode_mean(self, x: torch.Tensor, *cat_list: int):
+        r"""Deterministic encoding: only computes the mean \\( q_m \\) of the latent distribution,
+        skipping the variance head and the sampling.
+
+        :param x: tensor with shape (n_input,)
+        :param cat_list: list of category membership(s) for this sample
+        :return: tensor of shape ``(n_latent,)``
+        :rtype: :py:class:`torch.Tensor`
+        """
+        return self.mean_encoder(self.encoder(x, *cat_list)).float()
+
 
 # Decoder
 class DecoderSCVI(nn.Module):
@@ -152,17 +286,41 @@ class DecoderSCVI(nn.Module):
                                    n_cat_list=n_cat_list, n_layers=n_layers,
                                    n_hidden=n_hidden, dropout_rate=0)
 
-        # mean gamma
-        self.px_scale_decoder = nn.Sequential(nn.Linear(n_hidden, n_output), nn.Softmax(dim=-1))
-
-        # dispersion: here we only deal with gene-cell dispersion case
-        self.px_r_decoder = nn.Linear(n_hidden, n_output)
-
-        # dropout
-        self.px_dropout_decoder = nn.Linear(n_hidden, n_output)
+        # output heads fused in a single layer, whose rows are ordered as: mean gamma (scale logits),
+        # dropout, and dispersion (only used in the gene-cell dispersion case, it is last so it can be skipped)
+        self.n_output = n_output
+        self.px_heads = nn.Linear(n_hidden, 3 * n_output)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        # Former separate heads px_scale_decoder, px_dropout_decoder and px_r_decoder, stacked into px_heads
+        old_heads = [prefix + 'px_scale_decoder.0.', prefix + 'px_dropout_decoder.', prefix + 'px_r_decoder.']
+        if old_heads[0] + 'weight' in state_dict:
+            for param in ['weight', 'bias']:
+                state_dict[prefix + 'px_heads.' + param] = torch.cat(
+                    [state_dict.pop(head + param) for head in old_heads])
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                                      error_msgs)
+
+    def scale_logits(self, px: torch.Tensor, genes=None):
+        r"""Returns the logits of the frequencies of expression (before the softmax over all genes)
+        of ``genes``, or of all genes if ``None``
+
+        :param px: output of ``px_decoder``
+        :param genes: indices of the genes
+        """
+        if not isinstance(self.px_heads, nn.Linear):
+            px_scale_logits = self.px_heads(px)[..., :self.n_output].float()
+            return px_scale_logits[..., torch.as_tensor(genes, device=px.device)] if genes is not None \
+                else px_scale_logits
+        weight, bias = self.px_heads.weight[:self.n_output], self.px_heads.bias[:self.n_output]
+        if genes is not None:
+            genes = torch.as_tensor(genes, dtype=torch.long, device=px.device)
+            weight, bias = weight[genes], bias[genes]
+        return F.linear(px, weight, bias).float()
 
     def forward(self, dispersion: str, z: torch.Tensor, library: torch.Tensor,
-                *cat_list: int):
+                *cat_list: int, genes=None):
         r"""The forward computation for a single sample.
 
          #. Decodes the data from the latent space using the decoder network
@@ -179,17 +337,43 @@ class DecoderSCVI(nn.Module):
         :param z: tensor with shape ``(n_input,)``
         :param library: library size
         :param cat_list: list of category membership(s) for this sample
+        :param genes: indices of the genes to output, all genes if ``None``. The dropout and dispersion
+            heads are only evaluated for these genes, and the scale logits of the other genes only
+            contribute to the softmax normalizer
         :return: parameters for the ZINB distribution of expression
         :rtype: 4-tuple of :py:class:`torch.Tensor`
         """
 
         # The decoder returns values for the parameters of the ZINB distribution
         px = self.px_decoder(z, *cat_list)
-        px_scale = self.px_scale_decoder(px)
-        px_dropout = self.px_dropout_decoder(px)
+        # All the heads are computed in a single GEMM, the dispersion head only in the gene-cell case
+        n_heads = 3 if dispersion == "gene-cell" else 2
+        if not isinstance(self.px_heads, nn.Linear):
+            # layer without weight tensor (dynamically quantized): all the heads are computed, then sliced
+            px_scale_logits, px_dropout, *px_r = self.px_heads(px).float().split(self.n_output, dim=-1)[:n_heads]
+            px_scale = torch.softmax(px_scale_logits, dim=-1)
+            if genes is not None:
+                genes = torch.as_tensor(genes, dtype=torch.long, device=px.device)
+                px_scale, px_dropout = px_scale[..., genes], px_dropout[..., genes]
+                px_r = [px_r_[..., genes] for px_r_ in px_r]
+        elif genes is None:
+            n_rows = n_heads * self.n_output
+            # cast to float32, for the likelihood under a bfloat16 autocast
+            px_heads = F.linear(px, self.px_heads.weight[:n_rows], self.px_heads.bias[:n_rows]).float()
+            px_scale_logits, px_dropout, *px_r = px_heads.split(self.n_output, dim=-1)
+            px_scale = torch.softmax(px_scale_logits, dim=-1)
+        else:
+            genes = torch.as_tensor(genes, dtype=torch.long, device=px.device)
+            # the scale logits of all genes are needed for the normalizer
+            px_scale_logits = self.scale_logits(px)
+            px_scale = torch.exp(px_scale_logits[..., genes] - torch.logsumexp(px_scale_logits, dim=-1, keepdim=True))
+            weight = self.px_heads.weight.view(3, self.n_output, -1)[1:n_heads, genes]
+            bias = self.px_heads.bias.view(3, self.n_output)[1:n_heads, genes]
+            px_heads = F.linear(px, weight.reshape(-1, weight.size(-1)), bias.reshape(-1)).float()
+            px_dropout, *px_r = px_heads.split(len(genes), dim=-1)
         # Clamp to high value: exp(12) ~ 160000 to avoid nans (computational stability)
         px_rate = torch.exp(library) * px_scale  # torch.clamp( , max=12)
-        px_r = self.px_r_decoder(px) if dispersion == "gene-cell" else None
+        px_r = px_r[0] if px_r else None
         return px_scale, px_r, px_rate, px_dropout
 
 
@@ -212,9 +396,9 @@ class LinearDecoderSCVI(nn.Module):
         self.px_dropout_decoder = nn.Linear(n_input, n_output)
 
     def forward(self, dispersion: str, z: torch.Tensor, library: torch.Tensor,
-                *cat_list: int):
+                *cat_list: int, genes=None):
         # The decoder returns values for the parameters of the ZINB distribution
-        p1_ = self.factor_regressor(z)
+        p1_ = self.factor_regressor(z).float()
         if self.n_batches > 1:
             one_hot_cat = one_hot(cat_list[0], self.n_batches)[:, :-1]
             p2_ = self.batch_regressor(one_hot_cat)
@@ -222,8 +406,12 @@ class LinearDecoderSCVI(nn.Module):
         else:
             raw_px_scale = p1_
 
-        px_scale = torch.softmax(raw_px_scale, dim=-1)
-        px_dropout = self.px_dropout_decoder(z)
+        if genes is None:
+            px_scale = torch.softmax(raw_px_scale, dim=-1)
+        else:
+            genes = torch.as_tensor(genes, dtype=torch.long, device=z.device)
+            px_scale = torch.exp(raw_px_scale[..., genes] - torch.logsumexp(raw_px_scale, dim=-1, keepdim=True))
+        px_dropout = linear_genes(self.px_dropout_decoder, z, genes).float()
         px_rate = torch.exp(library) * px_scale
         px_r = None
 
@@ -270,6 +458,6 @@ class Decoder(nn.Module):
 
         # Parameters for latent distribution
         p = self.decoder(x, *cat_list)
-        p_m = self.mean_decoder(p)
-        p_v = torch.exp(self.var_decoder(p))
+        p_m = self.mean_decoder(p).float()
+        p_v = torch.exp(self.var_decoder(p).float())
         return p_m, p_v
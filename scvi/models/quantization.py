@@ -0,0 +1,42 @@
+"""Dynamic int8 quantization of trained models for CPU inference"""
+
+import copy
+
+import torch
+from torch import nn as nn
+
+from scvi.models.modules import FCLayers
+
+
+def fold_batch_norm(model):
+    r"""Folds in place the ``BatchNorm1d`` of the ``FCLayers`` of ``model`` into the preceding ``nn.Linear``:
+    their running statistics and affine parameters rescale its rows and shift its bias. Only the eval mode
+    computations are preserved.
+
+    :param model: A module whose ``FCLayers`` are folded
+    :return: ``model``
+    """
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, FCLayers):
+                for layers in module.fc_layers:
+                    linear, batch_norm = layers[0], layers[1]
+                    if isinstance(batch_norm, nn.BatchNorm1d) and batch_norm.track_running_stats:
+                        scale = batch_norm.weight / torch.sqrt(batch_norm.running_var + batch_norm.eps)
+                        linear.weight.mul_(scale.unsqueeze(1))
+                        linear.bias.copy_((linear.bias - batch_norm.running_mean) * scale + batch_norm.bias)
+                        layers._modules['1'] = None
+    return model
+
+
+def quantize_model(model, dtype=torch.qint8):
+    r"""Returns a copy of ``model`` for CPU inference, in eval mode, with the ``BatchNorm1d`` folded into the
+    preceding layers and all the ``nn.Linear`` layers (of the ``Encoder``, ``DecoderSCVI``, ``Classifier``...)
+    dynamically quantized: weights are stored in int8, and activations quantized on the fly.
+
+    :param model: A trained model
+    :param dtype: Type of the quantized weights
+    :return: The quantized copy of ``model``
+    """
+    model = fold_batch_norm(copy.deepcopy(model).cpu().eval())
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=dtype)
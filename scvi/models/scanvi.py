@@ -2,11 +2,11 @@ from typing import Sequence
 
 import numpy as np
 import torch
-from torch.distributions import Normal, Categorical, kl_divergence as kl
+from torch.distributions import Categorical, kl_divergence as kl
 
 from scvi.models.classifier import Classifier
 from scvi.models.modules import Decoder, Encoder
-from scvi.models.utils import broadcast_labels
+from scvi.models.utils import broadcast_labels, enumerate_top_labels, kl_normal, log1p, log_normal
 from scvi.models.vae import VAE
 
 
@@ -82,66 +82,88 @@ class SCANVI(VAE):
             self.n_groups = len(unique_groups)
             assert (unique_groups == np.arange(self.n_groups)).all()
             self.classifier_groups = Classifier(n_latent, n_hidden, self.n_groups, n_layers, dropout_rate)
-            self.groups_index = torch.nn.ParameterList([torch.nn.Parameter(
-                torch.tensor((self.labels_groups == i).astype(np.uint8), dtype=torch.uint8), requires_grad=False
-            ) for i in range(self.n_groups)])
+            # group of each label, for the segment normalization of the label probabilities within groups
+            self.register_buffer('labels_groups_index', torch.tensor(self.labels_groups, dtype=torch.long))
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        # Former per-group label masks, replaced by labels_groups_index which is derived from labels_groups
+        groups_index_keys = [key for key in state_dict if key.startswith(prefix + 'groups_index.')]
+        for key in groups_index_keys:
+            del state_dict[key]
+        if groups_index_keys and self.use_labels_groups:
+            state_dict.setdefault(prefix + 'labels_groups_index', self.labels_groups_index)
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                                      error_msgs)
 
     def classify(self, x):
         if self.log_variational:
-            x = torch.log(1 + x)
-        qz_m, _, z = self.z_encoder(x)
-        z = qz_m  # We classify using the inferred mean parameter of z_1 in the latent space
+            x = log1p(x)
+        z = self.z_encoder.encode_mean(x)  # We classify using the inferred mean parameter of z_1 in the latent space
+        return self.classify_latent(z)
+
+    def classify_latent(self, z):
+        r"""Label probabilities of cells of latent representation ``z``, as in ``classify``"""
         if self.use_labels_groups:
             w_g = self.classifier_groups(z)
             unw_y = self.classifier(z)
-            w_y = torch.zeros_like(unw_y)
-            for i, group_index in enumerate(self.groups_index):
-                unw_y_g = unw_y[:, group_index]
-                w_y[:, group_index] = unw_y_g / (unw_y_g.sum(dim=-1, keepdim=True) + 1e-8)
-                w_y[:, group_index] *= w_g[:, [i]]
+            # normalize label probabilities within each group, then weight them by the probability of the group
+            unw_g = torch.zeros_like(w_g).index_add_(1, self.labels_groups_index, unw_y)
+            w_y = unw_y / (unw_g.index_select(1, self.labels_groups_index) + 1e-8)
+            w_y = w_y * w_g.index_select(1, self.labels_groups_index)
         else:
             w_y = self.classifier(z)
         return w_y
 
     def get_latents(self, x, y=None):
         zs = super().get_latents(x)
-        qz2_m, qz2_v, z2 = self.encoder_z2_z1(zs[0], y)
         if not self.training:
-            z2 = qz2_m
+            z2 = self.encoder_z2_z1.encode_mean(zs[0], y)
+        else:
+            qz2_m, qz2_v, z2 = self.encoder_z2_z1(zs[0], y)
         return [zs[0], z2]
 
-    def forward(self, x, local_l_mean, local_l_var, batch_index=None, y=None):
+    def forward(self, x, local_l_mean, local_l_var, batch_index=None, y=None, top_k=None):
+        r""" Returns the reconstruction loss and the Kullback divergences
+
+        :param top_k: For unlabelled cells, if not ``None``, the expectation over the labels is approximated by
+         only enumerating the ``top_k`` most probable labels of each cell, instead of all of them
+        """
         is_labelled = False if y is None else True
 
         px_scale, px_r, px_rate, px_dropout, qz1_m, qz1_v, z1, ql_m, ql_v, library = self.inference(x, batch_index, y)
 
         # Enumerate choices of label
-        ys, z1s = (
-            broadcast_labels(
-                y, z1, n_broadcast=self.n_labels
+        if is_labelled or top_k is None or top_k >= self.n_labels:
+            ys, z1s = (
+                broadcast_labels(
+                    y, z1, n_broadcast=self.n_labels
+                )
             )
-        )
+            probs = weights = None
+        else:
+            probs = self.classifier(z1)
+            ys, z1s, weights = enumerate_top_labels(probs, z1, top_k=top_k)
         qz2_m, qz2_v, z2 = self.encoder_z2_z1(z1s, ys)
         pz1_m, pz1_v = self.decoder_z1_z2(z2, ys)
 
         reconst_loss = self._reconstruction_loss(x, px_rate, px_r, px_dropout)
 
         # KL Divergence
-        mean = torch.zeros_like(qz2_m)
-        scale = torch.ones_like(qz2_v)
-
-        kl_divergence_z2 = kl(Normal(qz2_m, torch.sqrt(qz2_v)), Normal(mean, scale)).sum(dim=1)
-        loss_z1_unweight = - Normal(pz1_m, torch.sqrt(pz1_v)).log_prob(z1s).sum(dim=-1)
-        loss_z1_weight = Normal(qz1_m, torch.sqrt(qz1_v)).log_prob(z1).sum(dim=-1)
-        kl_divergence_l = kl(Normal(ql_m, torch.sqrt(ql_v)), Normal(local_l_mean, torch.sqrt(local_l_var))).sum(dim=1)
+        kl_divergence_z2 = kl_normal(qz2_m, qz2_v).sum(dim=1)
+        loss_z1_unweight = - log_normal(z1s, pz1_m, pz1_v).sum(dim=-1)
+        loss_z1_weight = log_normal(z1, qz1_m, qz1_v).sum(dim=-1)
+        kl_divergence_l = kl_normal(ql_m, ql_v, local_l_mean, local_l_var).sum(dim=1)
 
         if is_labelled:
             return reconst_loss + loss_z1_weight + loss_z1_unweight, kl_divergence_z2 + kl_divergence_l
 
-        probs = self.classifier(z1)
-        reconst_loss += (loss_z1_weight + ((loss_z1_unweight).view(self.n_labels, -1).t() * probs).sum(dim=1))
+        if probs is None:
+            probs = weights = self.classifier(z1)
+        n_enumerated = weights.size(1)
+        reconst_loss += (loss_z1_weight + ((loss_z1_unweight).view(n_enumerated, -1).t() * weights).sum(dim=1))
 
-        kl_divergence = (kl_divergence_z2.view(self.n_labels, -1).t() * probs).sum(dim=1)
+        kl_divergence = (kl_divergence_z2.view(n_enumerated, -1).t() * weights).sum(dim=1)
         kl_divergence += kl(Categorical(probs=probs),
                             Categorical(probs=self.y_prior.repeat(probs.size(0), 1)))
         kl_divergence += kl_divergence_l
@@ -1,3 +1,5 @@
+import math
+
 import torch
 
 
@@ -26,6 +28,20 @@ def broadcast_labels(y, *o, n_broadcast=-1):
     return (ys,) + new_o
 
 
+def enumerate_top_labels(probs, *o, top_k=1):
+    '''
+    Utility for the semi-supervised setting, approximating the enumeration of ``broadcast_labels`` for an
+    unlabelled batch: only the ``top_k`` most probable labels of each cell are enumerated (rank by rank, as
+    ``enumerate_discrete`` does label by label) and other arguments are broadcast accordingly.
+    Also returns the ``(batch_size, top_k)`` probabilities of the enumerated labels, renormalized so that
+    the residual probability mass is spread over them.
+    '''
+    top_probs, top_labels = probs.topk(top_k, dim=-1)
+    ys = one_hot(top_labels.t().reshape(-1, 1), probs.size(-1))
+    new_o = iterate(o, lambda x: x.repeat(top_k, 1) if len(x.size()) == 2 else x.repeat(top_k))
+    return (ys,) + new_o + (top_probs / top_probs.sum(dim=-1, keepdim=True),)
+
+
 def one_hot(index, n_cat):
     onehot = torch.zeros(index.size(0), n_cat, device=index.device)
     onehot.scatter_(1, index.type(torch.long), 1)
@@ -39,3 +55,39 @@ def enumerate_discrete(x, y_dim):
 
     batch_size = x.size(0)
     return torch.cat([batch(batch_size, i) for i in range(y_dim)])
+
+
+def log1p(x):
+    r"""``log(1 + x)`` of a dense or sparse COO tensor ``x``. A sparse ``x`` stays sparse: only its nonzero
+    values are transformed.
+    """
+    if x.is_sparse:
+        x = x.coalesce()
+        return torch.sparse_coo_tensor(x.indices(), torch.log1p(x.values()), x.size())
+    return torch.log(1 + x)
+
+
+def reparameterize(mu, var):
+    r"""Reparameterized sample of :math:`\mathcal{N}(\mu, \mathrm{diag}(var))`, without constructing
+    a ``torch.distributions.Normal`` (and validating its arguments) at each call.
+    """
+    return torch.addcmul(mu, var.sqrt(), torch.randn_like(mu))
+
+
+def kl_normal(mu, var, prior_mu=None, prior_var=None):
+    r"""Elementwise closed-form :math:`KL(\mathcal{N}(\mu, var) \| \mathcal{N}(\mu_p, var_p))`.
+    The prior defaults to the standard normal, without allocating prior tensors.
+    """
+    if prior_mu is None:
+        return 0.5 * (var + mu * mu - 1. - torch.log(var))
+    return 0.5 * (torch.log(prior_var / var) + (var + (mu - prior_mu) ** 2) / prior_var - 1.)
+
+
+def log_normal(x, mu=None, var=None):
+    r"""Elementwise log density of :math:`\mathcal{N}(\mu, var)` at ``x``, standard normal by default.
+    ``var`` can be a tensor or a float.
+    """
+    if mu is None:
+        return -0.5 * (x * x + math.log(2 * math.pi))
+    return -0.5 * ((x - mu) ** 2 / var + torch.log(torch.as_tensor(var, dtype=x.dtype, device=x.device)) +
+                   math.log(2 * math.pi))
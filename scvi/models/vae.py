@@ -3,12 +3,10 @@
 
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
-from torch.distributions import Normal, kl_divergence as kl
 
-from scvi.models.log_likelihood import log_zinb_positive, log_nb_positive
+from scvi.models.log_likelihood import likelihood_kernels
 from scvi.models.modules import Encoder, DecoderSCVI, LinearDecoderSCVI
-from scvi.models.utils import one_hot
+from scvi.models.utils import log1p, reparameterize, kl_normal
 
 torch.backends.cudnn.benchmark = True
 
@@ -37,6 +35,12 @@ class VAE(nn.Module):
         * ``'nb'`` - Negative binomial distribution
         * ``'zinb'`` - Zero-inflated negative binomial distribution
 
+    :param likelihood_kernel:  One of
+
+        * ``'standard'`` - Reconstruction loss computed with autograd
+        * ``'fused'`` - Reconstruction loss with a hand-derived backward pass, using less memory
+        * ``'sparse'`` - Reconstruction loss evaluating the count dependent terms at nonzero entries only
+
     Examples:
         >>> gene_dataset = CortexDataset()
         >>> vae = VAE(gene_dataset.nb_genes, n_batch=gene_dataset.n_batches * False,
@@ -47,12 +51,14 @@ class VAE(nn.Module):
     def __init__(self, n_input: int, n_batch: int = 0, n_labels: int = 0,
                  n_hidden: int = 128, n_latent: int = 10, n_layers: int = 1,
                  dropout_rate: float = 0.1, dispersion: str = "gene",
-                 log_variational: bool = True, reconstruction_loss: str = "zinb"):
+                 log_variational: bool = True, reconstruction_loss: str = "zinb",
+                 likelihood_kernel: str = "standard"):
         super().__init__()
         self.dispersion = dispersion
         self.n_latent = n_latent
         self.log_variational = log_variational
         self.reconstruction_loss = reconstruction_loss
+        self.likelihood_kernel = likelihood_kernel
         # Automatically deactivate if useless
         self.n_batch = n_batch
         self.n_labels = n_labels
@@ -97,10 +103,10 @@ class VAE(nn.Module):
         :rtype: :py:class:`torch.Tensor`
         """
         if self.log_variational:
-            x = torch.log(1 + x)
-        qz_m, qz_v, z = self.z_encoder(x, y)  # y only used in VAEC
+            x = log1p(x)
         if give_mean:
-            z = qz_m
+            return self.z_encoder.encode_mean(x, y)  # y only used in VAEC
+        qz_m, qz_v, z = self.z_encoder(x, y)
         return z
 
     def sample_from_posterior_l(self, x):
@@ -113,55 +119,71 @@ class VAE(nn.Module):
         :rtype: :py:class:`torch.Tensor`
         """
         if self.log_variational:
-            x = torch.log(1 + x)
+            x = log1p(x)
         ql_m, ql_v, library = self.l_encoder(x)
         return library
 
-    def get_sample_scale(self, x, batch_index=None, y=None, n_samples=1):
+    def get_sample_scale(self, x, batch_index=None, y=None, n_samples=1, genes=None):
         r"""Returns the tensor of predicted frequencies of expression
 
         :param x: tensor of values with shape ``(batch_size, n_input)``
         :param batch_index: array that indicates which batch the cells belong to with shape ``batch_size``
         :param y: tensor of cell-types labels with shape ``(batch_size, n_labels)``
         :param n_samples: number of samples
+        :param genes: indices of the genes to return, all genes if ``None``
         :return: tensor of predicted frequencies of expression with shape ``(batch_size, n_input)``
         :rtype: :py:class:`torch.Tensor`
         """
-        return self.inference(x, batch_index=batch_index, y=y, n_samples=n_samples)[0]
+        return self.inference(x, batch_index=batch_index, y=y, n_samples=n_samples, genes=genes)[0]
 
-    def get_sample_rate(self, x, batch_index=None, y=None, n_samples=1):
+    def get_sample_rate(self, x, batch_index=None, y=None, n_samples=1, genes=None):
         r"""Returns the tensor of means of the negative binomial distribution
 
         :param x: tensor of values with shape ``(batch_size, n_input)``
         :param y: tensor of cell-types labels with shape ``(batch_size, n_labels)``
         :param batch_index: array that indicates which batch the cells belong to with shape ``batch_size``
         :param n_samples: number of samples
+        :param genes: indices of the genes to return, all genes if ``None``
         :return: tensor of means of the negative binomial distribution with shape ``(batch_size, n_input)``
         :rtype: :py:class:`torch.Tensor`
         """
-        return self.inference(x, batch_index=batch_index, y=y, n_samples=n_samples)[2]
+        return self.inference(x, batch_index=batch_index, y=y, n_samples=n_samples, genes=genes)[2]
 
     def _reconstruction_loss(self, x, px_rate, px_r, px_dropout):
         # Reconstruction Loss
+        log_zinb_positive, log_nb_positive = likelihood_kernels[self.likelihood_kernel]
         if self.reconstruction_loss == 'zinb':
             reconst_loss = -log_zinb_positive(x, px_rate, px_r, px_dropout)
         elif self.reconstruction_loss == 'nb':
             reconst_loss = -log_nb_positive(x, px_rate, px_r)
         return reconst_loss
 
-    def scale_from_z(self, sample_batch, fixed_batch):
+    def scale_from_z(self, sample_batch, fixed_batch, genes=None):
         if self.log_variational:
             sample_batch = torch.log(1 + sample_batch)
         qz_m, qz_v, z = self.z_encoder(sample_batch)
         batch_index = fixed_batch * torch.ones_like(sample_batch[:, [0]])
         library = 4. * torch.ones_like(sample_batch[:, [0]])
-        px_scale, _, _, _ = self.decoder('gene', z, library, batch_index)
+        px_scale, _, _, _ = self.decoder('gene', z, library, batch_index, genes=genes)
         return px_scale
 
-    def inference(self, x, batch_index=None, y=None, n_samples=1):
+    def _dispersion(self, px_r, batch_index=None, y=None, genes=None):
+        # px_r is the output of the decoder, only used for gene-cell dispersion
+        if self.dispersion != "gene-cell":
+            px_r = self.px_r if genes is None else self.px_r[torch.as_tensor(genes, device=self.px_r.device)]
+        # px_r gets transposed - last dimension is nb genes. Its columns are gathered rather than multiplied by
+        # one-hot encodings, which keeps them exact in float32 under a bfloat16 autocast. Labels enumerated by
+        # VAEC are already one-hot encoded
+        if self.dispersion == "gene-label":
+            px_r = px_r.t()[y.argmax(dim=-1) if y.size(-1) == self.n_labels else y.view(-1).long()]
+        elif self.dispersion == "gene-batch":
+            px_r = px_r.t()[batch_index.view(-1).long()]
+        return torch.exp(px_r)
+
+    def inference(self, x, batch_index=None, y=None, n_samples=1, genes=None):
         x_ = x
         if self.log_variational:
-            x_ = torch.log(1 + x_)
+            x_ = log1p(x_)
 
         # Sampling
         qz_m, qz_v, z = self.z_encoder(x_, y)
@@ -170,19 +192,14 @@ class VAE(nn.Module):
         if n_samples > 1:
             qz_m = qz_m.unsqueeze(0).expand((n_samples, qz_m.size(0), qz_m.size(1)))
             qz_v = qz_v.unsqueeze(0).expand((n_samples, qz_v.size(0), qz_v.size(1)))
-            z = Normal(qz_m, qz_v.sqrt()).sample()
             ql_m = ql_m.unsqueeze(0).expand((n_samples, ql_m.size(0), ql_m.size(1)))
             ql_v = ql_v.unsqueeze(0).expand((n_samples, ql_v.size(0), ql_v.size(1)))
-            library = Normal(ql_m, ql_v.sqrt()).sample()
+            with torch.no_grad():
+                z = reparameterize(qz_m, qz_v)
+                library = reparameterize(ql_m, ql_v)
 
-        px_scale, px_r, px_rate, px_dropout = self.decoder(self.dispersion, z, library, batch_index, y)
-        if self.dispersion == "gene-label":
-            px_r = F.linear(one_hot(y, self.n_labels), self.px_r)  # px_r gets transposed - last dimension is nb genes
-        elif self.dispersion == "gene-batch":
-            px_r = F.linear(one_hot(batch_index, self.n_batch), self.px_r)
-        elif self.dispersion == "gene":
-            px_r = self.px_r
-        px_r = torch.exp(px_r)
+        px_scale, px_r, px_rate, px_dropout = self.decoder(self.dispersion, z, library, batch_index, y, genes=genes)
+        px_r = self._dispersion(px_r, batch_index, y, genes=genes)
 
         return px_scale, px_r, px_rate, px_dropout, qz_m, qz_v, z, ql_m, ql_v, library
 
@@ -204,11 +221,8 @@ class VAE(nn.Module):
         px_scale, px_r, px_rate, px_dropout, qz_m, qz_v, z, ql_m, ql_v, library = self.inference(x, batch_index, y)
 
         # KL Divergence
-        mean = torch.zeros_like(qz_m)
-        scale = torch.ones_like(qz_v)
-
-        kl_divergence_z = kl(Normal(qz_m, torch.sqrt(qz_v)), Normal(mean, scale)).sum(dim=1)
-        kl_divergence_l = kl(Normal(ql_m, torch.sqrt(ql_v)), Normal(local_l_mean, torch.sqrt(local_l_var))).sum(dim=1)
+        kl_divergence_z = kl_normal(qz_m, qz_v).sum(dim=1)
+        kl_divergence_l = kl_normal(ql_m, ql_v, local_l_mean, local_l_var).sum(dim=1)
         kl_divergence = kl_divergence_z
 
         reconst_loss = self._reconstruction_loss(x, px_rate, px_r, px_dropout)
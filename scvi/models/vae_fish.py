@@ -3,13 +3,13 @@
 
 import torch
 import torch.nn.functional as F
-from torch.distributions import Normal, Poisson, kl_divergence as kl
+from torch.distributions import Poisson
 
 from scvi.models import VAE
 from scvi.models.classifier import Classifier
-from scvi.models.log_likelihood import log_zinb_positive, log_nb_positive
+from scvi.models.log_likelihood import likelihood_kernels
 from scvi.models.modules import Encoder, DecoderSCVI
-from scvi.models.utils import one_hot
+from scvi.models.utils import one_hot, kl_normal, log_normal
 
 torch.backends.cudnn.benchmark = True
 
@@ -31,6 +31,7 @@ class VAEF(VAE):
         :log_variational: Default: ``True``.
         :reconstruction_loss: Default: ``"zinb"``.
         :reconstruction_loss_fish: Default: ``"poisson"``.
+        :likelihood_kernel: Default: ``"standard"``.
 
     Examples:
         >>> gene_dataset_seq = CortexDataset()
@@ -43,10 +44,11 @@ class VAEF(VAE):
     def __init__(self, n_input, indexes_fish_train=None, n_batch=0, n_labels=0, n_hidden=128, n_latent=10,
                  n_layers=1, n_layers_decoder=1, dropout_rate=0.3,
                  dispersion="gene", log_variational=True, reconstruction_loss="zinb",
-                 reconstruction_loss_fish="poisson", model_library=False):
+                 reconstruction_loss_fish="poisson", model_library=False, likelihood_kernel="standard"):
         super().__init__(n_input, dispersion=dispersion, n_latent=n_hidden, n_hidden=n_hidden,
                          log_variational=log_variational, dropout_rate=dropout_rate, n_layers=1,
-                         reconstruction_loss=reconstruction_loss, n_batch=n_batch, n_labels=n_labels)
+                         reconstruction_loss=reconstruction_loss, n_batch=n_batch, n_labels=n_labels,
+                         likelihood_kernel=likelihood_kernel)
         self.n_input = n_input
         self.n_input_fish = len(indexes_fish_train)
         self.indexes_to_keep = indexes_fish_train
@@ -93,13 +95,13 @@ class VAEF(VAE):
         x = torch.log(1 + x)
         # First layer isn't shared
         if mode == "scRNA":
-            z, _, _ = self.z_encoder(x)
+            z = self.z_encoder.encode_mean(x)
         elif mode == "smFISH":
-            z, _, _ = self.z_encoder_fish(x[:, self.indexes_to_keep])
+            z = self.z_encoder_fish.encode_mean(x[:, self.indexes_to_keep])
         # The last layers of the encoder are shared
-        qz_m, qz_v, z = self.z_final_encoder(z)
         if not self.training:
-            z = qz_m
+            return self.z_final_encoder.encode_mean(z)
+        qz_m, qz_v, z = self.z_final_encoder(z)
         return z
 
     def sample_from_posterior_l(self, x, mode="scRNA"):
@@ -134,7 +136,7 @@ class VAEF(VAE):
         """
         z = self.sample_from_posterior_z(x, y, mode)  # y only used in VAEC
         px = self.decoder.px_decoder(z, batch_index, y)  # y only used in VAEC
-        px_scale = self.decoder.px_scale_decoder(px)
+        px_scale = torch.softmax(self.decoder.scale_logits(px), dim=-1)
         return px_scale
 
     def get_sample_rate(self, x, y=None, mode="scRNA"):
@@ -173,11 +175,15 @@ class VAEF(VAE):
 
         if self.model_library:
             library = self.sample_from_posterior_l(x, mode="smFISH")
-        px_scale = self.get_sample_scale(x, mode="smFISH", batch_index=batch_index, y=y)
-        px_scale = px_scale[:, self.indexes_to_keep] / torch.sum(px_scale[:, self.indexes_to_keep],
-                                                                 dim=1).view(-1, 1)
+        z = self.sample_from_posterior_z(x, y, "smFISH")
+        px_scale = self._fish_scale(z, batch_index, y)
         return px_scale * torch.exp(library)
 
+    def _fish_scale(self, z, batch_index, y=None):
+        # Frequencies of the smFISH genes renormalized among themselves: only their logits are decoded
+        px = self.decoder.px_decoder(z, batch_index, y)
+        return torch.softmax(self.decoder.scale_logits(px, self.indexes_to_keep), dim=-1)
+
     def classify(self, x, mode="scRNA"):
         r"""Classifies the cells based on their latent representation
         #for each cell, it gives the probability distribution over the different labels
@@ -188,7 +194,7 @@ class VAEF(VAE):
         :return: tensor of probabilities with shape``(batch_size, n_labels)``
         :rtype: :py:class:`torch.Tensor`
         """
-        z = self.sample_from_posterior_z(x, mode)
+        z = self.sample_from_posterior_z(x, mode=mode)
         return self.classifier(z)
 
     def _reconstruction_loss(self, x, px_rate, px_r, px_dropout, batch_index, y, mode="scRNA", weighting=1):
@@ -201,6 +207,7 @@ class VAEF(VAE):
 
         # Reconstruction Loss
         if mode == "scRNA":
+            log_zinb_positive, log_nb_positive = likelihood_kernels[self.likelihood_kernel]
             if self.reconstruction_loss == 'zinb':
                 reconst_loss = -log_zinb_positive(x, px_rate, torch.exp(px_r), px_dropout)
             elif self.reconstruction_loss == 'nb':
@@ -210,7 +217,7 @@ class VAEF(VAE):
             if self.reconstruction_loss_fish == 'poisson':
                 reconst_loss = -torch.sum(Poisson(px_rate).log_prob(x), dim=1)
             elif self.reconstruction_loss_fish == 'gaussian':
-                reconst_loss = -torch.sum(Normal(px_rate, 10).log_prob(x), dim=1)
+                reconst_loss = -torch.sum(log_normal(x, px_rate, 100.), dim=1)
         return reconst_loss
 
     def forward(self, x, local_l_mean, local_l_var, batch_index=None, y=None, mode="scRNA", weighting=1):
@@ -248,32 +255,28 @@ class VAEF(VAE):
                 ql_m, ql_v, library = self.l_encoder_fish(x_[:, self.indexes_to_keep])
 
         qz_m, qz_v, z = self.z_final_encoder(z)
-        px_scale, px_r, px_rate, px_dropout = self.decoder(self.dispersion, z, library, batch_index)
 
         # rescaling the expected frequencies
         if mode == "smFISH":
             if self.model_library:
-                px_rate = px_scale[:, self.indexes_to_keep] * torch.exp(library)
+                px_scale, px_r, px_rate, px_dropout = self.decoder(self.dispersion, z, library, batch_index,
+                                                                   genes=self.indexes_to_keep)
                 reconst_loss = self._reconstruction_loss(x[:, self.indexes_to_keep], px_rate, px_r, px_dropout,
                                                          batch_index, y, mode)
             else:
-                px_scale = px_scale[:, self.indexes_to_keep] / torch.sum(
-                    px_scale[:, self.indexes_to_keep], dim=1).view(-1, 1)
+                px_scale = self._fish_scale(z, batch_index)
                 px_rate = px_scale * torch.exp(library)
-                reconst_loss = self._reconstruction_loss(x[:, self.indexes_to_keep], px_rate, px_r, px_dropout,
+                reconst_loss = self._reconstruction_loss(x[:, self.indexes_to_keep], px_rate, None, None,
                                                          batch_index, y, mode)
 
         else:
+            px_scale, px_r, px_rate, px_dropout = self.decoder(self.dispersion, z, library, batch_index)
             reconst_loss = self._reconstruction_loss(x, px_rate, px_r, px_dropout, batch_index, y, mode, weighting)
 
         # KL Divergence
-        mean = torch.zeros_like(qz_m)
-        scale = torch.ones_like(qz_v)
-
-        kl_divergence_z = kl(Normal(qz_m, torch.sqrt(qz_v)), Normal(mean, scale)).sum(dim=1)
+        kl_divergence_z = kl_normal(qz_m, qz_v).sum(dim=1)
         if self.model_library:
-            kl_divergence_l = kl(Normal(ql_m, torch.sqrt(ql_v)), Normal(local_l_mean,
-                                                                        torch.sqrt(local_l_var))).sum(dim=1)
+            kl_divergence_l = kl_normal(ql_m, ql_v, local_l_mean, local_l_var).sum(dim=1)
             kl_divergence = kl_divergence_z + kl_divergence_l
         else:
             kl_divergence = kl_divergence_z
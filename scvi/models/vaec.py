@@ -1,9 +1,9 @@
 import torch
-from torch.distributions import Normal, Categorical, kl_divergence as kl
+from torch.distributions import Categorical, kl_divergence as kl
 
 from scvi.models.classifier import Classifier
 from scvi.models.modules import Encoder, DecoderSCVI
-from scvi.models.utils import broadcast_labels
+from scvi.models.utils import broadcast_labels, enumerate_top_labels, kl_normal
 from scvi.models.vae import VAE
 
 
@@ -64,40 +64,55 @@ class VAEC(VAE):
         x = torch.log(1 + x)
         return self.classifier(x)
 
-    def forward(self, x, local_l_mean, local_l_var, batch_index=None, y=None):
+    def forward(self, x, local_l_mean, local_l_var, batch_index=None, y=None, top_k=None):
+        r""" Returns the reconstruction loss and the Kullback divergences
+
+        :param top_k: For unlabelled cells, if not ``None``, the expectation over the labels is approximated by
+         only enumerating the ``top_k`` most probable labels of each cell, instead of all of them
+        """
         is_labelled = False if y is None else True
 
         # Prepare for sampling
         x_ = torch.log(1 + x)
         ql_m, ql_v, library = self.l_encoder(x_)
 
-        # Enumerate choices of label
-        ys, xs, library_s, batch_index_s = (
-            broadcast_labels(
-                y, x, library, batch_index, n_broadcast=self.n_labels
+        # Enumerate choices of label, x itself is not repeated
+        if is_labelled or top_k is None or top_k >= self.n_labels:
+            ys, library_s, batch_index_s = (
+                broadcast_labels(
+                    y, library, batch_index, n_broadcast=self.n_labels
+                )
             )
+            probs = weights = None
+        else:
+            probs = self.classifier(x_)
+            ys, library_s, batch_index_s, weights = enumerate_top_labels(probs, library, batch_index, top_k=top_k)
+
+        # Sampling: the first layer of the z encoder computes its x dependent part once for all the labels
+        qz_m, qz_v, z = self.z_encoder(x_ if self.log_variational else x, ys)
+        px_scale, px_r, px_rate, px_dropout = self.decoder(self.dispersion, z, library_s, batch_index_s, ys)
+        px_r = self._dispersion(px_r, batch_index_s, ys)
+
+        # (n_labels * batch_size, n_input) parameters viewed as (n_labels, batch_size, n_input) to broadcast x
+        px_rate, px_r, px_dropout = (
+            t.view(-1, *x.size()) if t.dim() == 2 and t.size(0) != x.size(0) else t
+            for t in (px_rate, px_r, px_dropout)
         )
-
-        # Sampling
-        px_scale, px_r, px_rate, px_dropout, qz_m, qz_v, z, _, _, _ = self.inference(xs, batch_index_s, ys)
-        reconst_loss = self._reconstruction_loss(xs, px_rate, px_r, px_dropout)
+        reconst_loss = self._reconstruction_loss(x, px_rate, px_r, px_dropout).view(-1)
 
         # KL Divergence
-        mean = torch.zeros_like(qz_m)
-        scale = torch.ones_like(qz_v)
-
-        kl_divergence_z = kl(Normal(qz_m, torch.sqrt(qz_v)), Normal(mean, scale)).sum(dim=1)
-        kl_divergence_l = kl(Normal(ql_m, torch.sqrt(ql_v)), Normal(local_l_mean, torch.sqrt(local_l_var))).sum(dim=1)
+        kl_divergence_z = kl_normal(qz_m, qz_v).sum(dim=1)
+        kl_divergence_l = kl_normal(ql_m, ql_v, local_l_mean, local_l_var).sum(dim=1)
 
         if is_labelled:
             return reconst_loss, kl_divergence_z + kl_divergence_l
 
-        reconst_loss = reconst_loss.view(self.n_labels, -1)
-
-        probs = self.classifier(x_)
-        reconst_loss = (reconst_loss.t() * probs).sum(dim=1)
+        if probs is None:
+            probs = weights = self.classifier(x_)
+        n_enumerated = weights.size(1)
+        reconst_loss = (reconst_loss.view(n_enumerated, -1).t() * weights).sum(dim=1)
 
-        kl_divergence = (kl_divergence_z.view(self.n_labels, -1).t() * probs).sum(dim=1)
+        kl_divergence = (kl_divergence_z.view(n_enumerated, -1).t() * weights).sum(dim=1)
         kl_divergence += kl(Categorical(probs=probs),
                             Categorical(probs=self.y_prior.repeat(probs.size(0), 1)))
         kl_divergence += kl_divergence_l
@@ -4,21 +4,41 @@
 
 """Tests for `scvi` package."""
 
+import copy
+import json
+import os.path
+from multiprocessing.reduction import ForkingPickler
+import pickle
+import socket
+import tempfile
+
+import anndata
 import numpy as np
+import scipy.sparse as sp_sparse
+import torch
+from torch.distributions import Normal, kl_divergence as kl
 
-from scvi.benchmark import all_benchmarks, benchmark, benchmark_fish_scrna, ldvae_benchmark
+import scvi.dataset.dataset
+from scvi.benchmark import all_benchmarks, benchmark, benchmark_fish_scrna, ldvae_benchmark, \
+    elbo_overhead_benchmark, mixed_precision_benchmark
 from scvi.dataset import BrainLargeDataset, CortexDataset, RetinaDataset, BrainSmallDataset, HematoDataset, \
     LoomDataset, AnnDataset, CsvDataset, CiteSeqDataset, CbmcDataset, PbmcDataset, SyntheticDataset, \
     SeqfishDataset, SmfishDataset, BreastCancerDataset, MouseOBDataset, \
     GeneExpressionDataset, PurifiedPBMCDataset, SyntheticDatasetCorr, ZISyntheticDatasetCorr, \
     Dataset10X
-from scvi.inference import JointSemiSupervisedTrainer, AlternateSemiSupervisedTrainer, ClassifierTrainer, \
-    UnsupervisedTrainer, AdapterTrainer
+from scvi.inference import Posterior, JointSemiSupervisedTrainer, AlternateSemiSupervisedTrainer, \
+    ClassifierTrainer, UnsupervisedTrainer, AdapterTrainer
 from scvi.inference.annotation import compute_accuracy_rf, compute_accuracy_svc
+from scvi.inference.distributed import get_rank, launch, shard_indices
+from scvi.inference.profiling import ModuleProfiler, TrainingProfiler
 from scvi.models import VAE, SCANVI, VAEC
 from scvi.models.classifier import Classifier
-import anndata
-import os.path
+from scvi.models.export import export_encoder, load_encoder
+from scvi.models.log_likelihood import compute_marginal_log_likelihood, log_nb_positive, log_nb_positive_fused, \
+    log_nb_positive_sparse, log_zinb_positive, log_zinb_positive_fused, log_zinb_positive_sparse
+from scvi.models.modules import FCLayers
+from scvi.models.quantization import fold_batch_norm
+from scvi.models.utils import enumerate_discrete, kl_normal, log_normal, one_hot
 
 use_cuda = True
 
@@ -316,3 +336,511 @@ def test_new_10x():
     data = Dataset10X('pbmc_1k_v2')
     data.subsample_genes(new_n_genes=100)
     assert data.X.shape[1] == 100
+
+
+def test_shared_memory_dataset():
+    for to_sparse in [False, True]:
+        synthetic_dataset = SyntheticDataset()
+        if to_sparse:
+            synthetic_dataset.X = sp_sparse.csr_matrix(synthetic_dataset.X)
+        X = synthetic_dataset.X.copy()
+        synthetic_dataset.share_memory()
+        for state in [bytes(ForkingPickler.dumps(synthetic_dataset)),
+                      pickle.dumps(synthetic_dataset.shared_reference())]:
+            attached_dataset = pickle.loads(state)
+            assert len(state) < X.data.nbytes
+            assert type(attached_dataset) is SyntheticDataset
+            assert (attached_dataset.X != X).sum() == 0
+            assert (attached_dataset.labels == synthetic_dataset.labels).all()
+            del attached_dataset
+        synthetic_dataset.unshare_memory()
+        assert (synthetic_dataset.X != X).sum() == 0
+        assert len(ForkingPickler.dumps(synthetic_dataset)) > X.data.nbytes
+
+
+def test_shared_memory_dataset_copies():
+    # plain pickles and deep copies of a shared dataset hold their own data
+    synthetic_dataset = SyntheticDataset().share_memory()
+    X = synthetic_dataset.X.copy()
+    state = pickle.dumps(synthetic_dataset)
+    assert len(state) > X.nbytes
+    copied_dataset = copy.deepcopy(synthetic_dataset)
+    copied_dataset.X[0, 0] += 1
+    assert synthetic_dataset.X[0, 0] == X[0, 0]
+    assert not getattr(copied_dataset, '_shared_handles', None)
+    synthetic_dataset.unshare_memory()
+    unpickled_dataset = pickle.loads(state)
+    assert (unpickled_dataset.X == X).all()
+    assert (unpickled_dataset.labels == synthetic_dataset.labels).all()
+
+
+def test_shared_memory_spawn_workers(monkeypatch):
+    for available in [True, False]:
+        if not available:  # python < 3.8: the dataset is copied to the workers
+            monkeypatch.setattr(scvi.dataset.dataset, 'shared_memory', None)
+        synthetic_dataset = SyntheticDataset()
+        posterior = Posterior(None, synthetic_dataset, use_cuda=False, data_loader_kwargs={
+            'batch_size': 64, 'num_workers': 1, 'multiprocessing_context': 'spawn'})
+        assert bool(getattr(synthetic_dataset, '_shared_handles', None)) == available
+        X = np.concatenate([tensors[0].numpy() for tensors in posterior])
+        assert (X == synthetic_dataset.X).all()
+        synthetic_dataset.unshare_memory()
+
+
+def test_fc_layers_covariate_injection():
+    fc_layers = FCLayers(10, 8, n_cat_list=[3, 1, 4], n_layers=2, n_hidden=16).eval()
+    x = torch.randn(5, 10)
+    batch_index, labels = torch.randint(3, (5, 1)), torch.randint(4, (5, 1))
+    for cat_list in [(batch_index, None, labels), (batch_index, None, one_hot(labels, 4))]:
+        embedded = fc_layers(x, *cat_list)
+        fc_layers.covariate_injection = 'one_hot'
+        concatenated = fc_layers(x, *cat_list)
+        fc_layers.covariate_injection = 'embedding'
+        assert torch.allclose(embedded, concatenated, atol=1e-6)
+
+
+def test_fc_layers_multi_sample():
+    fc_layers = FCLayers(10, 8, n_cat_list=[3], n_layers=2, n_hidden=16)
+    fc_layers(torch.randn(20, 10), torch.randint(3, (20, 1)))  # update running statistics
+    fc_layers.eval()
+    x, batch_index = torch.randn(4, 5, 10), torch.randint(3, (5, 1))
+    per_sample = torch.stack([fc_layers(slice_x, batch_index) for slice_x in x])
+    assert torch.allclose(fc_layers(x, batch_index), per_sample, atol=1e-6)
+
+
+def test_fused_likelihood_kernel():
+    x = torch.distributions.Poisson(3 * torch.rand(20, 15)).sample()
+    mu = (5 * torch.rand(2, 20, 15) + 0.01).requires_grad_()
+    theta = (torch.rand(15) + 0.1).requires_grad_()
+    pi = torch.randn(20, 15).requires_grad_()
+    for log_lkl, log_lkl_fused, params in [(log_zinb_positive, log_zinb_positive_fused, (mu, theta, pi)),
+                                           (log_nb_positive, log_nb_positive_fused, (mu, theta))]:
+        res, res_fused = log_lkl(x, *params), log_lkl_fused(x, *params)
+        assert torch.allclose(res, res_fused, rtol=1e-5, atol=1e-4)
+        weights = torch.randn_like(res)
+        grads = torch.autograd.grad((weights * res).sum(), params)
+        grads_fused = torch.autograd.grad((weights * res_fused).sum(), params)
+        for grad, grad_fused in zip(grads, grads_fused):
+            assert torch.allclose(grad, grad_fused, rtol=1e-4, atol=1e-4)
+
+    synthetic_dataset = SyntheticDataset()
+    for reconstruction_loss in ['zinb', 'nb']:
+        vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches, reconstruction_loss=reconstruction_loss,
+                  likelihood_kernel='fused')
+        trainer = UnsupervisedTrainer(vae, synthetic_dataset, train_size=0.5, use_cuda=use_cuda)
+        trainer.train(n_epochs=1)
+
+
+def test_sparse_likelihood_kernel():
+    x = torch.distributions.Poisson(torch.rand(20, 15)).sample()
+    mu, theta, pi = 5 * torch.rand(2, 20, 15) + 0.01, torch.rand(15) + 0.1, torch.randn(20, 15)
+    for log_lkl, log_lkl_sparse, params in [(log_zinb_positive, log_zinb_positive_sparse, (mu, theta, pi)),
+                                            (log_nb_positive, log_nb_positive_sparse, (mu, theta))]:
+        res = log_lkl(x, *params)
+        assert torch.allclose(res, log_lkl_sparse(x, *params), rtol=1e-5, atol=1e-4)
+        assert torch.allclose(res, log_lkl_sparse(x.to_sparse(), *params), rtol=1e-5, atol=1e-4)
+
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches, likelihood_kernel='sparse')
+    trainer = UnsupervisedTrainer(vae, synthetic_dataset, train_size=0.5, use_cuda=use_cuda)
+    trainer.train(n_epochs=1)
+
+
+def test_closed_form_gaussian_terms():
+    mu, var, prior_mu, prior_var = torch.randn(5, 3), torch.rand(5, 3) + 0.1, torch.randn(5, 3), torch.rand(5, 3) + 0.1
+    x = torch.randn(5, 3)
+    assert torch.allclose(kl_normal(mu, var), kl(Normal(mu, var.sqrt()), Normal(0., 1.)), atol=1e-5)
+    assert torch.allclose(kl_normal(mu, var, prior_mu, prior_var),
+                          kl(Normal(mu, var.sqrt()), Normal(prior_mu, prior_var.sqrt())), atol=1e-5)
+    assert torch.allclose(log_normal(x, mu, var), Normal(mu, var.sqrt()).log_prob(x), atol=1e-5)
+    elbo_overhead_benchmark(n_steps=10)
+
+
+def test_encode_mean():
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches).eval()
+    x = torch.log(1 + torch.from_numpy(synthetic_dataset.X[:10]).float())
+    assert torch.allclose(vae.z_encoder.encode_mean(x), vae.z_encoder(x)[0])
+    trainer = UnsupervisedTrainer(vae, synthetic_dataset, train_size=0.5, use_cuda=use_cuda)
+    latent, _, _ = trainer.train_set.get_latent()
+    assert latent.shape == (len(trainer.train_set.indices), vae.n_latent)
+
+
+def test_vaec_label_enumeration():
+    synthetic_dataset = SyntheticDataset()
+    vaec = VAEC(synthetic_dataset.nb_genes, synthetic_dataset.n_batches, synthetic_dataset.n_labels).eval()
+    x = torch.log(1 + torch.from_numpy(synthetic_dataset.X[:10]).float())
+    ys = enumerate_discrete(x, synthetic_dataset.n_labels)
+    assert torch.allclose(vaec.z_encoder.encode_mean(x, ys),
+                          vaec.z_encoder.encode_mean(x.repeat(synthetic_dataset.n_labels, 1), ys), atol=1e-6)
+
+
+def test_top_k_marginalization():
+    synthetic_dataset = SyntheticDataset(n_labels=5)
+    for model in [SCANVI(synthetic_dataset.nb_genes, synthetic_dataset.n_batches, synthetic_dataset.n_labels),
+                  VAEC(synthetic_dataset.nb_genes, synthetic_dataset.n_batches, synthetic_dataset.n_labels)]:
+        trainer = JointSemiSupervisedTrainer(model, synthetic_dataset, top_k=2, use_cuda=use_cuda)
+        trainer.train(n_epochs=1)
+        assert trainer.unlabelled_set.marginalization_gap(top_k=synthetic_dataset.n_labels) < 1e-6
+        assert trainer.unlabelled_set.marginalization_gap(top_k=2) > 0
+        model.cpu().eval()
+        sample_batch, local_l_mean, local_l_var, batch_index, _ = next(iter(trainer.unlabelled_set))
+        losses = []
+        for top_k in [None, synthetic_dataset.n_labels, 2]:
+            torch.manual_seed(0)
+            losses += [sum(model(sample_batch.cpu(), local_l_mean.cpu(), local_l_var.cpu(), batch_index.cpu(),
+                                 top_k=top_k))]
+        assert torch.allclose(losses[0], losses[1]) and not torch.allclose(losses[0], losses[2])
+    trainer = AlternateSemiSupervisedTrainer(model, synthetic_dataset, top_k=2, n_epochs_classifier=1,
+                                             use_cuda=use_cuda)
+    trainer.train(n_epochs=1)
+
+
+def test_scanvi_labels_groups():
+    synthetic_dataset = SyntheticDataset(n_labels=5)
+    labels_groups = [0, 1, 0, 2, 1]
+    scanvi = SCANVI(synthetic_dataset.nb_genes, synthetic_dataset.n_batches, synthetic_dataset.n_labels,
+                    labels_groups=labels_groups, use_labels_groups=True)
+    trainer = JointSemiSupervisedTrainer(scanvi, synthetic_dataset, use_cuda=use_cuda)
+    trainer.train(n_epochs=1)
+    trainer.unlabelled_set.hierarchical_accuracy()
+
+    scanvi.eval()
+    x = torch.from_numpy(synthetic_dataset.X[:10]).float()
+    z = scanvi.z_encoder.encode_mean(torch.log(1 + x))
+    w_g, unw_y = scanvi.classifier_groups(z), scanvi.classifier(z)
+    w_y = torch.zeros_like(unw_y)
+    for group in range(3):
+        group_index = torch.tensor(np.array(labels_groups) == group)
+        w_y[:, group_index] = unw_y[:, group_index] / (unw_y[:, group_index].sum(dim=-1, keepdim=True) + 1e-8)
+        w_y[:, group_index] *= w_g[:, [group]]
+    assert torch.allclose(scanvi.classify(x), w_y, atol=1e-6)
+
+
+def test_decode_gene_subset():
+    synthetic_dataset = SyntheticDataset()
+    genes = np.array([3, 0, 7])
+    x = torch.from_numpy(synthetic_dataset.X[:10]).float()
+    batch_index = torch.from_numpy(synthetic_dataset.batch_indices[:10]).long()
+    for dispersion in ["gene", "gene-cell"]:
+        vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches, dispersion=dispersion).eval()
+        torch.manual_seed(0)
+        full = vae.inference(x, batch_index, n_samples=2)
+        torch.manual_seed(0)
+        subset = vae.inference(x, batch_index, n_samples=2, genes=genes)
+        for full_param, subset_param in zip(full[:4], subset[:4]):
+            assert torch.allclose(full_param[..., genes], subset_param, atol=1e-6)
+    trainer = UnsupervisedTrainer(vae, synthetic_dataset, train_size=0.5, use_cuda=use_cuda)
+    gene_names = synthetic_dataset.gene_names[genes]
+    trainer.train_set.differential_expression_score(synthetic_dataset.labels.ravel() == 0,
+                                                    synthetic_dataset.labels.ravel() == 1,
+                                                    genes=gene_names, n_samples=2, M_permutation=10)
+    assert trainer.train_set.generate(n_samples=2, genes=gene_names)[0].shape[1] == len(genes)
+
+
+def test_fused_decoder_heads():
+    synthetic_dataset = SyntheticDataset()
+    x = torch.from_numpy(synthetic_dataset.X[:10]).float()
+    batch_index = torch.from_numpy(synthetic_dataset.batch_indices[:10]).long()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches, dispersion="gene-cell").eval()
+    # checkpoint with the former separate heads
+    state_dict = vae.state_dict()
+    fused = {param: state_dict.pop('decoder.px_heads.' + param).chunk(3) for param in ['weight', 'bias']}
+    scale_head, dropout_head, r_head = [{param: fused[param][i] for param in fused} for i in range(3)]
+    for name, head in [('px_scale_decoder.0', scale_head), ('px_dropout_decoder', dropout_head),
+                       ('px_r_decoder', r_head)]:
+        for param, value in head.items():
+            state_dict['decoder.%s.%s' % (name, param)] = value
+    loaded_vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches, dispersion="gene-cell").eval()
+    loaded_vae.load_state_dict(state_dict)
+    z = torch.randn(10, vae.n_latent)
+    px = loaded_vae.decoder.px_decoder(z, batch_index)
+    px_scale, px_r, _, px_dropout = loaded_vae.decoder("gene-cell", z, torch.zeros(10, 1), batch_index)
+    assert torch.allclose(px_scale, torch.softmax(px @ scale_head['weight'].t() + scale_head['bias'], dim=-1))
+    assert torch.allclose(px_dropout, px @ dropout_head['weight'].t() + dropout_head['bias'], atol=1e-6)
+    assert torch.allclose(px_r, px @ r_head['weight'].t() + r_head['bias'], atol=1e-6)
+    assert loaded_vae.decoder("gene", z, torch.zeros(10, 1), batch_index)[1] is None
+    torch.manual_seed(0)
+    loss = vae(x, torch.zeros(10, 1), torch.ones(10, 1), batch_index)
+    torch.manual_seed(0)
+    assert torch.allclose(loss[0], loaded_vae(x, torch.zeros(10, 1), torch.ones(10, 1), batch_index)[0])
+
+
+def test_sparse_encoder_input():
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches, likelihood_kernel="sparse")
+    trainer = UnsupervisedTrainer(vae, synthetic_dataset, train_size=0.5, use_cuda=use_cuda)
+    trainer.train(n_epochs=1)
+    posterior = trainer.train_set.sequential()
+    assert np.allclose(posterior.get_latent()[0], posterior.sparse().get_latent()[0], atol=1e-5)
+    sample_batch, local_l_mean, local_l_var, batch_index, labels = next(iter(posterior.sparse()))
+    assert sample_batch.is_sparse
+    vae.eval()
+    torch.manual_seed(0)
+    loss = vae(sample_batch, local_l_mean, local_l_var, batch_index)[0]
+    torch.manual_seed(0)
+    assert torch.allclose(loss, vae(sample_batch.to_dense(), local_l_mean, local_l_var, batch_index)[0])
+
+
+def test_marginal_ll_chunks():
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trainer = UnsupervisedTrainer(vae, synthetic_dataset, train_size=0.5, use_cuda=use_cuda)
+    trainer.train(n_epochs=1)
+    vae.eval()
+    posterior = trainer.test_set.sequential()
+    # a single sample per chunk or all samples in one chunk
+    torch.manual_seed(0)
+    marginal_ll_one_chunk = compute_marginal_log_likelihood(vae, posterior, 20)
+    torch.manual_seed(0)
+    marginal_ll_chunks = compute_marginal_log_likelihood(vae, posterior, 20, memory_budget=1)
+    assert np.isfinite(marginal_ll_one_chunk) and np.isfinite(marginal_ll_chunks)
+    assert abs(marginal_ll_one_chunk - marginal_ll_chunks) < 0.05 * abs(marginal_ll_one_chunk)
+    assert np.isfinite(posterior.marginal_ll(n_mc_samples=200, tol=1e3))
+
+
+def test_export_encoder():
+    synthetic_dataset = SyntheticDataset()
+    scanvi = SCANVI(synthetic_dataset.nb_genes, synthetic_dataset.n_batches, synthetic_dataset.n_labels)
+    trainer = JointSemiSupervisedTrainer(scanvi, synthetic_dataset, use_cuda=use_cuda)
+    trainer.train(n_epochs=1)
+    scanvi.cpu().eval()
+    x = torch.from_numpy(synthetic_dataset.X[:10]).float()
+    with tempfile.TemporaryDirectory() as save_path:
+        path = os.path.join(save_path, 'encoder.pt')
+        export_encoder(scanvi, path, classify=True)
+        encoder, metadata = load_encoder(path)
+        z, probs = encoder(x)
+        assert torch.allclose(z, scanvi.sample_from_posterior_z(x, give_mean=True), atol=1e-5)
+        assert torch.allclose(probs, scanvi.classify(x), atol=1e-5)
+        # served panel: genes in reverse order, without the first gene of the model
+        gene_names = synthetic_dataset.gene_names[:0:-1]
+        export_encoder(scanvi, path, gene_names=gene_names, model_gene_names=synthetic_dataset.gene_names)
+        encoder, metadata = load_encoder(path)
+        assert metadata['gene_names'] == list(gene_names) and metadata['n_latent'] == scanvi.n_latent
+        x_model = x.clone()
+        x_model[:, 0] = 0
+        assert torch.allclose(encoder(x[:, 1:].flip(1)), scanvi.sample_from_posterior_z(x_model, give_mean=True),
+                              atol=1e-5)
+
+
+def test_quantized_inference():
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trainer = UnsupervisedTrainer(vae, synthetic_dataset, train_size=0.5, use_cuda=use_cuda)
+    trainer.train(n_epochs=1)
+    vae.cpu().eval()
+    x = torch.from_numpy(synthetic_dataset.X[:10]).float()
+    batch_index = torch.from_numpy(synthetic_dataset.batch_indices[:10]).long()
+    folded_vae = fold_batch_norm(copy.deepcopy(vae))
+    torch.manual_seed(0)
+    px_scale = vae.get_sample_scale(x, batch_index)
+    torch.manual_seed(0)
+    assert torch.allclose(folded_vae.get_sample_scale(x, batch_index), px_scale, atol=1e-6)
+    report = trainer.train_set.quantization_report()
+    assert report['latent_relative_error'] < 0.1 and report['neighbors_agreement'] > 0.5
+    quantized = trainer.train_set.quantized()
+    assert quantized.get_sample_scale().shape == (len(quantized.indices), synthetic_dataset.nb_genes)
+
+
+def test_fc_layers_folded_eval():
+    fc_layers = FCLayers(20, 8, n_cat_list=[3, 4], n_layers=2, n_hidden=16)
+    optimizer = torch.optim.SGD(fc_layers.parameters(), lr=0.1)
+    x, cat_1, cat_2 = torch.randn(50, 20), torch.randint(3, (50, 1)), torch.randint(4, (50, 1))
+    for _ in range(2):
+        fc_layers.train()
+        fc_layers(x, cat_1, cat_2).sum().backward()  # updates the running statistics
+        optimizer.step()
+        fc_layers.eval()
+        reference = fc_layers(x, cat_1, cat_2)  # grad enabled: BatchNorm modules
+        with torch.no_grad():
+            assert torch.allclose(fc_layers(x, cat_1, cat_2), reference, atol=1e-5)
+            assert torch.allclose(fc_layers(x.expand(2, 50, 20), cat_1, cat_2), reference.expand(2, 50, 8),
+                                  atol=1e-5)
+
+
+def test_mixed_precision():
+    synthetic_dataset = SyntheticDataset()
+    results = mixed_precision_benchmark(synthetic_dataset, n_epochs=2, use_cuda=use_cuda)
+    assert len(results['bfloat16']['ll_test_set']) == len(results['float32']['ll_test_set'])
+    vaec = VAEC(synthetic_dataset.nb_genes, synthetic_dataset.n_batches, synthetic_dataset.n_labels,
+                dispersion="gene-label")
+    trainer = JointSemiSupervisedTrainer(vaec, synthetic_dataset, use_cuda=use_cuda, mixed_precision=True)
+    trainer.train(n_epochs=1)
+    vaec.cpu()
+    x = torch.from_numpy(synthetic_dataset.X[:10]).float()
+    with trainer.autocast():
+        qz_m, qz_v, z = vaec.z_encoder(x, torch.zeros(10, 1))
+        assert qz_m.dtype == qz_v.dtype == torch.float32
+        assert vaec.classify(x).dtype == torch.float32
+
+
+def _train_distributed(save_path):
+    torch.manual_seed(get_rank())  # different initializations, replaced by the one of rank 0
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trainer = UnsupervisedTrainer(vae, synthetic_dataset, train_size=0.5, use_cuda=False, frequency=1,
+                                  distributed=True, early_stopping_kwargs={'early_stopping_metric': 'll',
+                                                                           'patience': 1, 'threshold': 1e4})
+    trainer.train(n_epochs=5)
+    assert len(trainer.train_set.shard().indices) <= 150
+    torch.save({'state_dict': vae.state_dict(), 'history': dict(trainer.history)},
+               os.path.join(save_path, 'rank_%d.pt' % get_rank()))
+
+
+def test_distributed_training(tmpdir):
+    shards = [shard_indices(np.arange(10), rank=rank, world_size=3) for rank in range(3)]
+    assert all(len(shard) == 4 for shard in shards)
+    assert set(np.concatenate(shards)) == set(range(10))
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    launch(_train_distributed, 2, str(tmpdir), master_port=port)
+    rank_0, rank_1 = (torch.load(os.path.join(str(tmpdir), 'rank_%d.pt' % rank)) for rank in range(2))
+    assert rank_0['history'] == rank_1['history']
+    assert len(rank_0['history']['ll_test_set']) == 4  # stopped early, at the same epoch on both ranks
+    for key, value in rank_0['state_dict'].items():
+        assert torch.allclose(value, rank_1['state_dict'][key])
+
+
+def test_checkpoint_resume(tmpdir):
+    synthetic_dataset = SyntheticDataset()
+    trainer_kwargs = {'train_size': 0.5, 'use_cuda': use_cuda, 'frequency': 1,
+                      'early_stopping_kwargs': {'save_best_state_metric': 'll'}}
+
+    torch.manual_seed(0)
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trainer = UnsupervisedTrainer(vae, synthetic_dataset, **trainer_kwargs)
+    trainer.train(n_epochs=4)
+
+    torch.manual_seed(0)
+    interrupted_vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    interrupted_trainer = UnsupervisedTrainer(interrupted_vae, synthetic_dataset, checkpoint_kwargs={
+        'save_path': str(tmpdir), 'frequency': 2}, **trainer_kwargs)
+    interrupted_trainer.train(n_epochs=2)
+    assert os.path.exists(os.path.join(str(tmpdir), 'checkpoint.pt'))
+    assert os.path.exists(os.path.join(str(tmpdir), 'best.pt'))
+
+    resumed_vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    resumed_trainer = UnsupervisedTrainer(resumed_vae, synthetic_dataset, checkpoint_kwargs={
+        'save_path': str(tmpdir)}, **trainer_kwargs)
+    resumed_trainer.resume()
+    resumed_trainer.train(n_epochs=4)
+    assert resumed_trainer.history['ll_test_set'] == trainer.history['ll_test_set']
+    assert resumed_trainer.best_epoch == trainer.best_epoch
+    for key, value in vae.state_dict().items():
+        assert torch.allclose(value, resumed_vae.state_dict()[key])
+
+
+def test_training_profiler(tmpdir):
+    synthetic_dataset = SyntheticDataset()
+    svaec = SCANVI(synthetic_dataset.nb_genes, synthetic_dataset.n_batches, synthetic_dataset.n_labels)
+    trainer = AlternateSemiSupervisedTrainer(svaec, synthetic_dataset, use_cuda=use_cuda, frequency=1,
+                                             profile='trace')
+    trainer.train(n_epochs=2)
+    for phase in ['data', 'forward', 'loss', 'backward', 'step', 'epoch_end', 'metrics', 'classifier']:
+        assert len(trainer.history['profile_' + phase]) == 2
+    assert all(t > 0 for t in trainer.history['profile_forward'] + trainer.history['profile_classifier'])
+    assert trainer.history['profile_epoch_end'][0] >= trainer.history['profile_metrics'][0]
+    assert trainer.history['profile_cells_per_s'][0] > 0 and trainer.history['profile_peak_rss'][0] > 0
+    trainer.profiler.save_chrome_trace(str(tmpdir.join('trace.json')))
+    with open(str(tmpdir.join('trace.json'))) as f:
+        assert {event['name'] for event in json.load(f)['traceEvents']} >= {'data', 'forward', 'backward'}
+    trainer.profiler.save_json(str(tmpdir.join('profile.json')))
+    profiler = TrainingProfiler()  # events are only kept with trace, up to max_events
+    with profiler.phase('data'):
+        pass
+    assert not profiler.events
+    profiler = TrainingProfiler(trace=True, max_events=3)
+    for _ in range(5):
+        with profiler.phase('data'):
+            pass
+    assert len(profiler.events) == 3
+
+
+def test_module_profiler():
+    synthetic_dataset = SyntheticDataset()
+    svaec = SCANVI(synthetic_dataset.nb_genes, synthetic_dataset.n_batches, synthetic_dataset.n_labels)
+    trainer = JointSemiSupervisedTrainer(svaec, synthetic_dataset, use_cuda=use_cuda)
+    with ModuleProfiler(svaec, enabled=False) as module_profiler:
+        assert not module_profiler._hooks
+    with ModuleProfiler(svaec) as module_profiler:
+        trainer.train(n_epochs=1)
+    assert not svaec.decoder._forward_hooks and not svaec.z_encoder.encoder.fc_layers[0][0].weight._backward_hooks
+    report = module_profiler.report()
+    assert {'z_encoder', 'l_encoder', 'decoder', 'classifier', 'encoder_z2_z1', 'decoder_z1_z2'} <= set(report.index)
+    assert report.loc['decoder', 'type'] == 'DecoderSCVI'
+    assert (report.loc['decoder', ['calls', 'forward_time', 'backward_time', 'output_bytes']] > 0).all()
+    # the inputs of the encoders do not require grad: their backward is the gradient of their weights
+    assert (report.loc[['z_encoder', 'l_encoder', 'z_encoder.encoder'], 'backward_time'] > 0).all()
+
+
+def test_async_metrics():
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trainer = UnsupervisedTrainer(vae, synthetic_dataset, train_size=0.5, use_cuda=use_cuda, frequency=1,
+                                  async_metrics=True, metrics_lag=2,
+                                  early_stopping_kwargs={'save_best_state_metric': 'll', 'on': 'test_set'})
+    trainer.train(n_epochs=4)
+    assert not trainer._pending_metrics
+    # initial, one per epoch, and the best state
+    assert len(trainer.history['ll_train_set']) == len(trainer.history['ll_test_set']) == 6
+    # the evaluation of the restored best state does not compete with the evaluations of the training
+    assert trainer.best_epoch == np.argmin(trainer.history['ll_test_set'][1:5])
+    assert min(trainer.history['ll_test_set'][1:5]) == trainer.early_stopping.best_performance_state
+    # the evaluation thread does not outlive the training, and is started again by the next one
+    assert trainer._metrics_executor is None
+    trainer.train(n_epochs=1)
+    assert trainer._metrics_executor is None
+    assert len(trainer.history['ll_test_set']) == 9
+
+
+def test_subsampled_metrics(capsys):
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trainer = UnsupervisedTrainer(vae, synthetic_dataset, train_size=0.5, use_cuda=use_cuda, frequency=1,
+                                  early_stopping_kwargs={'early_stopping_metric': 'll', 'on': 'test_set',
+                                                         'threshold_std_errors': 2})
+    test_set = trainer.test_set.subsample(60, seed=1)
+    assert np.array_equal(test_set.indices, trainer.test_set.subsample(60, seed=1).indices)
+    assert len(test_set.indices) == len(set(test_set.indices)) == 60
+    assert set(test_set.indices) <= set(trainer.test_set.indices)
+    batches = synthetic_dataset.batch_indices.ravel()
+    assert abs((batches[test_set.indices] == 0).mean() - (batches[trainer.test_set.indices] == 0).mean()) < 0.05
+    trainer.test_set = test_set
+    trainer.train(n_epochs=2)
+    assert len(trainer.history['ll_test_set_std_error']) == len(trainer.history['ll_test_set']) == 3
+    assert all(std_error > 0 for std_error in trainer.history['ll_test_set_std_error'])
+    wait = trainer.early_stopping.wait
+    assert trainer.early_stopping.update(trainer.early_stopping.best_performance - 1, std_error=1.)[0]
+    assert trainer.early_stopping.wait == wait + 1  # an improvement below 2 standard errors is not significant
+    trainer.early_stopping.patience = trainer.early_stopping.wait
+    capsys.readouterr()
+    assert not trainer.early_stopping.update(trainer.early_stopping.best_performance, std_error=1.5)[0]
+    assert "no improvement of more than 3.0 nats" in capsys.readouterr().out
+
+
+def test_running_metrics():
+    synthetic_dataset = SyntheticDataset()
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trainer = UnsupervisedTrainer(vae, synthetic_dataset, train_size=0.5, use_cuda=use_cuda,
+                                  early_stopping_kwargs={'early_stopping_metric': 'elbo', 'on': 'running',
+                                                         'save_best_state_metric': 'elbo', 'patience': 1,
+                                                         'threshold': 1e4})
+    trainer.train(n_epochs=5)
+    assert not trainer.history['ll_train_set']  # no evaluation pass
+    assert len(trainer.history['elbo_running']) == 3  # stopped early
+    assert np.allclose(trainer.history['elbo_running'], np.add(trainer.history['reconstruction_loss_running'],
+                                                               trainer.history['kl_divergence_running']))
+    svaec = SCANVI(synthetic_dataset.nb_genes, synthetic_dataset.n_batches, synthetic_dataset.n_labels)
+    trainer = JointSemiSupervisedTrainer(svaec, synthetic_dataset, use_cuda=use_cuda)
+    trainer.train(n_epochs=1)
+    assert len(trainer.history['kl_divergence_running']) == 1
+    # the running metrics are synchronous, and still save the best state with asynchronous evaluations
+    vae = VAE(synthetic_dataset.nb_genes, synthetic_dataset.n_batches)
+    trainer = UnsupervisedTrainer(vae, synthetic_dataset, train_size=0.5, use_cuda=use_cuda, frequency=1,
+                                  async_metrics=True,
+                                  early_stopping_kwargs={'save_best_state_metric': 'elbo', 'on': 'running'})
+    trainer.train(n_epochs=5)
+    assert trainer.best_epoch == np.argmin(trainer.history['elbo_running'])
+    assert trainer.early_stopping.best_performance_state == min(trainer.history['elbo_running'])